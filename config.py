@@ -10,6 +10,10 @@ num_anchors = len(anchors) // 3
 
 
 image_input_shape = (608, 608)
+# 多尺度训练: 每multi_scale_interval个batch从multi_scale_shapes中换一个输入尺寸(32的倍数), None关闭
+# 如 [(320, 320), (352, 352), (384, 384), (416, 416), (448, 448), (480, 480), (512, 512), (544, 544), (576, 576), (608, 608)]
+multi_scale_shapes = None
+multi_scale_interval = 10
 # anchor使用顺序
 anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
 # 放缩比例
@@ -20,6 +24,18 @@ jitter = 0.3
 hue = 0.1
 sat = 1.5
 val = 1.5
+# 颜色增强: 'lut' uint8查表(快), 'float' 浮点hsv
+color_mode = 'lut'
+# 数据增强策略: 按顺序执行, p为执行概率, 其余为该操作的参数
+augment_policy = {
+    'rotate': {'p': 1 / 3, 'angels': (0, 90, 180, 270)},
+    'flip': {'p': 1 / 3, 'flip_codes': (-1, 0, 1)},
+    'pixel': {'p': 1 / 2, 'pixel_num': 10, 'mask_ratio': 0.3, 'kernel_ratio': 0.1},
+    'mixup': {'p': 1 / 4},
+    'mosaic': {'p': 1 / 3},
+    'resize': {'p': 1., 'scale': (0.5, 1.5)},
+    'colors': {'p': 2 / 3, 'hue': hue, 'sat': sat, 'val': val, 'mode': color_mode},
+}
 # iou阈值
 ignore_thresh = 0.5
 
@@ -27,8 +43,33 @@ ignore_thresh = 0.5
 validation_split = 0.1
 batch_size = 8
 epochs = 1000
+# 数据加载: 'generator' 单进程, 'parallel' 多进程, 'tf_data' tf.data
+loader = 'generator'
+workers = 4
+prefetch = 4
+seed = None
+# flip, 颜色增强和归一化在整个batch上执行(utils_image.BatchAugment)
+batch_augment = False
+# 图片以uint8送入模型, 在模型内归一化(models.YOLO(uint8_input=True))
+uint8_input = False
+# 网络计算精度: 'float32', 'mixed_bfloat16'(CPU), 'mixed_float16'(GPU, 自动使用loss scaling), loss和解码始终为float32
+precision = 'float32'
+# 预测时Mish使用单exp的快速形式(models.Mish(fast=True)), 与训练时的精确形式有约1e-6的误差
+fast_mish = False
+# y_true在模型内由padding后的box编码(loss.yolo4_box_loss), 生成器不再输出稠密的y_true
+encode_in_graph = False
+# train_loop.py: 每次更新累加subdivisions个batch的梯度, 即train_net.cfg中的batch=batch_size*subdivisions
+# 如batch=64 subdivisions=16, 取batch_size = 4, subdivisions = 16
+subdivisions = 1
+# train_loop.py: 前向和loss用XLA编译. CPU上编译整个608x608模型需数十分钟, 多尺度训练每个新尺寸都会重新编译
+jit_compile = False
 
 score = 0.5
 iou = 0.5
 
-label_path = '/opt/voc2007/labels.txt'
\ No newline at end of file
+label_path = '/opt/voc2007/labels.txt'
+# pack.py打包后的数据前缀, 设置后训练从shard读取, 如 '/opt/voc2007/shards/voc'
+shard_path = None
+# 解码图片缓存大小(字节), 0为关闭. 每个加载进程各一份, parallel下总内存约为(workers + 1) * cache_bytes
+# 如 512 * 1024 ** 2
+cache_bytes = 0
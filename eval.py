@@ -1,28 +1,40 @@
 import numpy as np
 from tools import utils
-from models import YOLO
-from tensorflow.keras import backend as K
 
 
-def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
+# (grid_h, grid_w, input_shape, anchors) -> flattened grid and anchors of one output layer
+_head_cache = {}
+
+
+def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape, scale=None, offset=None):
     """
 
     :param box_xy:          (N, 13, 13, 3, 2)
     :param box_wh:          (N, 13, 13, 3, 2)
     :param input_shape:     (416, 416)
-    :param image_shape:     (None, None)
+    :param image_shape:     (None, None), or (..., 2) broadcastable to box_xy with one shape per box
+    :param scale:           optional (..., 2) (y, x) scales returned by utils_image.letterbox, with offset they give
+                            the exact placement of the image instead of the one estimated from image_shape
+    :param offset:          optional (..., 2) (y, x) pixel offsets returned by utils_image.letterbox
     :return:
     """
     box_yx = box_xy[..., ::-1]
     box_hw = box_wh[..., ::-1]
 
-    input_shape = K.cast(input_shape, box_xy.dtype)
-    image_shape = K.cast(image_shape, box_xy.dtype)
-    new_shape = np.round(image_shape * np.min(input_shape / image_shape))
-    offset = (input_shape - new_shape) / 2. / input_shape
-    scale = input_shape / new_shape
-    box_yx = (box_yx - offset) * scale
-    box_hw *= scale
+    input_shape = np.asarray(input_shape, dtype=box_xy.dtype)
+    image_shape = np.asarray(image_shape, dtype=box_xy.dtype)
+    if scale is not None:
+        # relative to the input -> relative to the raw image
+        scale = np.asarray(scale, dtype=box_xy.dtype)
+        offset = np.asarray(offset, dtype=box_xy.dtype)
+        box_yx = (box_yx * input_shape - offset) / scale / image_shape
+        box_hw = box_hw * input_shape / scale / image_shape
+    else:
+        new_shape = np.round(image_shape * np.min(input_shape / image_shape, axis=-1, keepdims=True))
+        offset = (input_shape - new_shape) / 2. / input_shape
+        scale = input_shape / new_shape
+        box_yx = (box_yx - offset) * scale
+        box_hw = box_hw * scale
 
     box_mins = box_yx - (box_hw / 2.)
     box_maxes = box_yx + (box_hw / 2.)
@@ -38,21 +50,147 @@ def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
     return boxes
 
 
-def yolo_boxes_and_scores(feats, anchors, num_classes, input_shape, image_shape):
-    '''Process Conv layer output'''
+def yolo_head_constants(grid_shape, anchors, input_shape, dtype='float32'):
+    """
+    grid offsets and normalized anchors of one layer, flattened the same way as
+    feats.reshape(N, h * w * num_anchors, 5 + num_classes), cached per shape
 
+    :param grid_shape:      (h, w)
+    :param anchors:         (3, 2)
+    :param input_shape:     (608, 608)
+    :return:                grid (h * w * 3, 2) x, y;  anchors (h * w * 3, 2) w, h relative to input shape
+    """
+    h, w = grid_shape
+    key = (h, w, tuple(input_shape), np.asarray(anchors).tobytes(), dtype)
+    if key not in _head_cache:
+        num_anchors = len(anchors)
+        grid_y, grid_x = np.meshgrid(np.arange(h), np.arange(w), indexing='ij')
+        grid = np.stack([grid_x, grid_y], axis=-1)
+        grid = np.repeat(grid.reshape(-1, 2), num_anchors, axis=0).astype(dtype)
+        anchors = np.asarray(anchors, dtype=dtype) / np.asarray(input_shape[::-1], dtype=dtype)
+        anchors = np.tile(anchors, (h * w, 1))
+        _head_cache[key] = grid, anchors
+    return _head_cache[key]
+
+
+def yolo_decode(yolo_outputs,
+                anchors,
+                num_classes,
+                image_shapes,
+                score_threshold=.6,
+                scales=None,
+                offsets=None):
+    """
+
+    decode all layers of a whole batch at once.
+    score = confidence * class prob <= confidence, so boxes whose confidence is below score_threshold
+    are dropped before class probs and boxes are computed.
 
-    box_xy, box_wh, box_confidence, box_class_probs = YOLO.yolo_head(feats, anchors, num_classes, input_shape)
+    :param yolo_outputs:    [(N, 19, 19, 3 * (5 + num_classes)), (N, 38, 38, ...), (N, 76, 76, ...)]
+    :param anchors:         (9, 2)
+    :param num_classes:
+    :param image_shapes:    (N, 2) raw (h, w) of every image, or one (h, w) for all
+    :param score_threshold:
+    :param scales:          optional (N, 2) scales of utils_image.letterbox
+    :param offsets:         optional (N, 2) offsets of utils_image.letterbox
+    :return:                batch_index (x, ), boxes (x, 4), box_scores (x, num_classes)
+    """
+    num_layers = len(yolo_outputs)
+    anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
 
+    input_shape = tuple(int(s) * 32 for s in yolo_outputs[0].shape[1:3])
+    batch = yolo_outputs[0].shape[0]
+    image_shapes = np.broadcast_to(np.reshape(image_shapes, (-1, 2)), (batch, 2))
 
-    boxes = yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape)
-    # (x, 4)
-    boxes = np.reshape(boxes, [-1, 4])
-    box_scores = box_confidence * box_class_probs
-    # (x, 10)
-    box_scores = np.reshape(box_scores, [-1, num_classes])
-    # (x, 4), (x, 10)
-    return boxes, box_scores
+    batch_index = []
+    boxes_xy = []
+    boxes_wh = []
+    box_scores = []
+    for l in range(num_layers):
+        feats = np.asarray(yolo_outputs[l])
+        h, w = feats.shape[1:3]
+        grid, anchors_wh = yolo_head_constants((h, w), anchors[anchor_mask[l]], input_shape, feats.dtype)
+        # (N, h * w * 3, 5 + num_classes)
+        feats = np.reshape(feats, [batch, -1, num_classes + 5])
+
+        box_confidence = utils.sigmoid(feats[..., 4])
+        b, t = np.nonzero(box_confidence >= score_threshold)
+        candidates = feats[b, t]
+
+        batch_index.append(b)
+        boxes_xy.append((utils.sigmoid(candidates[:, :2]) + grid[t]) / np.asarray([w, h], dtype=feats.dtype))
+        boxes_wh.append(np.exp(candidates[:, 2:4]) * anchors_wh[t])
+        box_scores.append(box_confidence[b, t, None] * utils.sigmoid(candidates[:, 5:]))
+
+    batch_index = np.concatenate(batch_index)
+    if scales is not None:
+        scales = np.broadcast_to(np.reshape(scales, (-1, 2)), (batch, 2))[batch_index]
+        offsets = np.broadcast_to(np.reshape(offsets, (-1, 2)), (batch, 2))[batch_index]
+    boxes = yolo_correct_boxes(np.concatenate(boxes_xy), np.concatenate(boxes_wh),
+                               input_shape, image_shapes[batch_index], scales, offsets)
+    return batch_index, boxes, np.concatenate(box_scores)
+
+
+def yolo_batch_nms(batch_index,
+                   boxes,
+                   box_scores,
+                   num_images,
+                   num_classes,
+                   max_boxes=100,
+                   score_threshold=.6,
+                   iou_threshold=.5,
+                   max_total_boxes=None):
+    """
+
+    class-aware NMS of every image in one call
+
+    :param batch_index:     (x, ) output of yolo_decode
+    :param boxes:           (x, 4)
+    :param box_scores:      (x, num_classes)
+    :param num_images:
+    :param num_classes:
+    :param max_boxes:       at most max_boxes of each class
+    :param score_threshold:
+    :param iou_threshold:
+    :param max_total_boxes: at most max_total_boxes of each image over all classes, None for no limit
+    :return:                list of (boxes, scores, classes) sorted by score, one per image
+    """
+    # 每个(box, class)组合作为候选
+    rows, classes = np.nonzero(box_scores >= score_threshold)
+    images = np.asarray(batch_index)[rows]
+    scores = box_scores[rows, classes]
+
+    keep = utils.batched_nms(boxes[rows], scores, images * num_classes + classes, iou_threshold, max_boxes)
+    if max_total_boxes is not None:
+        keep = utils.limit_per_group(keep, images[keep], max_total_boxes)
+
+    results = []
+    for i in range(num_images):
+        image_keep = keep[images[keep] == i]
+        results.append((boxes[rows[image_keep]], scores[image_keep], classes[image_keep].astype('int32')))
+    return results
+
+
+def yolo_nms(boxes,
+             box_scores,
+             num_classes,
+             max_boxes=100,
+             score_threshold=.6,
+             iou_threshold=.5,
+             max_total_boxes=None):
+    """
+
+    :param boxes:           (x, 4)
+    :param box_scores:      (x, num_classes)
+    :param num_classes:
+    :param max_boxes:
+    :param score_threshold:
+    :param iou_threshold:
+    :param max_total_boxes:
+    :return:
+    """
+    return yolo_batch_nms(np.zeros(len(boxes), dtype=int), boxes, box_scores, 1, num_classes,
+                          max_boxes, score_threshold, iou_threshold, max_total_boxes)[0]
 
 
 def yolo_eval(yolo_outputs,
@@ -61,56 +199,21 @@ def yolo_eval(yolo_outputs,
               image_shape,
               max_boxes=100,
               score_threshold=.6,
-              iou_threshold=.5):
+              iou_threshold=.5,
+              max_total_boxes=None):
     """
 
-    TODO: optimization below steps in the future
-    predict -> correct -> nms -> output
+    predict -> decode (with correct) -> nms -> output
 
-    :param yolo_outputs:
+    :param yolo_outputs:    outputs of one image
     :param anchors:         (9, 2)
     :param num_classes:
     :param image_shape:     (None, None)
     :param max_boxes:
     :param score_threshold:
     :param iou_threshold:
+    :param max_total_boxes: limit over all classes
     :return:
     """
-    image_shape = np.array(image_shape)
-    num_layers = len(yolo_outputs)
-    anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
-
-    input_shape = np.array(yolo_outputs[0].shape[1:3]) * 32
-    boxes = []
-    box_scores = []
-    for l in range(num_layers):
-        # (x, 4), (x, 10)
-        _boxes, _box_scores = yolo_boxes_and_scores(yolo_outputs[l],
-                                                    anchors[anchor_mask[l]], num_classes, input_shape, image_shape)
-        boxes.append(_boxes)
-        box_scores.append(_box_scores)
-    # (x, 4)
-    boxes = np.concatenate(boxes, axis=0)
-    # (x, le of classes)
-    box_scores = np.concatenate(box_scores, axis=0)
-
-    mask = box_scores >= score_threshold
-    boxes_ = []
-    scores_ = []
-    classes_ = []
-    for c in range(num_classes):
-        class_boxes = boxes[mask[:, c]]
-        class_box_scores = box_scores[:, c][mask[:, c]]
-
-        nms_index = utils.nms(class_boxes, class_box_scores, iou_threshold, max_boxes)
-        class_boxes = class_boxes[nms_index]
-        class_box_scores = class_box_scores[nms_index]
-        classes = np.ones_like(class_box_scores, 'int32') * c
-        boxes_.append(class_boxes)
-        scores_.append(class_box_scores)
-        classes_.append(classes)
-    boxes_ = np.concatenate(boxes_, axis=0)
-    scores_ = np.concatenate(scores_, axis=0)
-    classes_ = np.concatenate(classes_, axis=0)
-
-    return boxes_, scores_, classes_
+    _, boxes, box_scores = yolo_decode(yolo_outputs, anchors, num_classes, image_shape, score_threshold)
+    return yolo_nms(boxes, box_scores, num_classes, max_boxes, score_threshold, iou_threshold, max_total_boxes)
@@ -3,7 +3,12 @@ generator
 """
 
 import numpy as np
-from tools import utils_image, utils
+import tensorflow as tf
+import multiprocessing
+import queue
+import traceback
+from multiprocessing import shared_memory
+from tools import utils_image, utils, utils_data
 import config
 
 
@@ -43,32 +48,114 @@ def preprocess_true_boxes(true_boxes: np.ndarray,
     y_true = [np.zeros((batch_size, grid_shapes[l][0], grid_shapes[l][1], len(config.anchor_mask[l]), 5 + num_classes),
                        dtype='float32') for l in range(num_layers)]
 
-    # 开始挑选最优anchor
-    for N in range(batch_size):
-        # Discard zero rows， 因为默认20个zeors_like, 一般都不够20的，有很多0填充项
-        # (x, 2)
-        wh = boxes_wh[N, valid_mask[N]]
-        if len(boxes_wh) == 0:
-            continue
+    # 一次性为整个batch的所有box挑选最优anchor, (N, max_box)
+    best_anchor_indexes = utils.iou_area_index(boxes_wh, anchors)
+
+    # (x, ), 有效box按(N, t)顺序展开, 同一格子被多个box命中时与逐个写入一样后者覆盖前者
+    batch_indexes, box_indexes = np.nonzero(valid_mask)
+    best_anchor_indexes = best_anchor_indexes[batch_indexes, box_indexes]
+    valid_boxes = true_boxes[batch_indexes, box_indexes]
+    class_indexes = valid_boxes[:, 4].astype('int32')
+
+    for l in range(num_layers):
+        # anchor序号 -> 该层内的序号k, 不属于该层的为-1
+        k_table = np.full(len(anchors), -1, dtype='int32')
+        k_table[config.anchor_mask[l]] = np.arange(len(config.anchor_mask[l]))
+        k = k_table[best_anchor_indexes]
+        layer_mask = k >= 0
 
-        # 对于每个box，从9个anchor中，选出最佳anchor
-        # (x, )
-        best_anchor_indexes = utils.iou_area_index(wh, anchors)
-
-        for t, n in enumerate(best_anchor_indexes):
-            for l in range(num_layers):
-                if n in config.anchor_mask[l]:
-                    i = np.floor(true_boxes[N, t, 0] * grid_shapes[l][1]).astype('int32')
-                    j = np.floor(true_boxes[N, t, 1] * grid_shapes[l][0]).astype('int32')
-                    k = config.anchor_mask[l].index(n)
-                    c = true_boxes[N, t, 4].astype('int32')
-                    y_true[l][N, j, i, k, 0:4] = true_boxes[N, t, 0:4]
-                    y_true[l][N, j, i, k, 4] = 1
-                    y_true[l][N, j, i, k, 5 + c] = 1
+        b = batch_indexes[layer_mask]
+        k = k[layer_mask]
+        boxes = valid_boxes[layer_mask]
+        c = class_indexes[layer_mask]
+        i = np.floor(boxes[:, 0].astype('float64') * grid_shapes[l][1]).astype('int32')
+        j = np.floor(boxes[:, 1].astype('float64') * grid_shapes[l][0]).astype('int32')
+
+        y_true[l][b, j, i, k, 0:4] = boxes[:, 0:4]
+        y_true[l][b, j, i, k, 4] = 1
+        y_true[l][b, j, i, k, 5 + c] = 1
     return y_true
 
 
-def data_generator(label_lines, batch_size, input_shape, anchors, num_classes):
+def sample_rng(seed, batch_index, b):
+    """
+    random state of the b-th sample of a batch, the same sample of the same run gets the same augment
+    in every loader and every process
+    """
+    return np.random.RandomState([seed % 2 ** 32, batch_index % 2 ** 32, b])
+
+
+def batch_rng(seed, batch_index):
+    """
+    random state of the batch level augment (utils_image.BatchAugment) of a batch
+    """
+    return np.random.RandomState([seed % 2 ** 32, batch_index % 2 ** 32])
+
+
+def batch_input_shape(seed, batch_index, input_shape, input_shapes=None, scale_interval=10):
+    """
+    input shape of a batch for multi-scale training, a new one is drawn from input_shapes every scale_interval
+    batches. it only depends on seed and batch_index, so every loader and every process agree on it
+
+    :param seed:
+    :param batch_index:
+    :param input_shape:         shape used when input_shapes is empty
+    :param input_shapes:        [(h, w), ...], multiples of 32
+    :param scale_interval:      count of batches between two switches
+    :return:                    (h, w)
+    """
+    if not input_shapes:
+        return tuple(input_shape)
+    period = batch_index // scale_interval
+    # 4 words, so it never replays the stream of sample_rng or batch_rng
+    rng = np.random.RandomState([seed % 2 ** 32, period % 2 ** 32, 0, 0])
+    return tuple(input_shapes[rng.randint(len(input_shapes))])
+
+
+def check_input_shapes(input_shapes):
+    for h, w in input_shapes:
+        assert h % 32 == 0 and w % 32 == 0, 'input shape {} is not a multiple of 32'.format((h, w))
+
+
+def load_sample(sample, input_shape, max_boxes=20, img_info_list=None, rng=None, policy=None, normalize=True):
+    """
+    decode, augment and pad one sample
+
+    :param sample:              one line of labels file, (path, boxes) from a tools.utils_data.AnnotationIndex
+                                or (image, boxes) from a tools.utils_data.ShardReader
+    :param input_shape:         images' input shape
+    :param max_boxes:           boxes are padded with zeros up to max_boxes
+    :param img_info_list:       where mixup and mosaic draw their extra images from
+    :param rng:                 random state of the augment, see sample_rng
+    :param policy:              augment policy, default is config.augment_policy
+    :param normalize:           False to return raw pixels in [0, 255], for utils_image.BatchAugment
+    :return:                    image (h, w, 3), boxes (max_boxes, 5)
+    """
+    if isinstance(sample, str):
+        info = sample.split()
+        image_file_path, cors = info[0], info[1:]
+        cors = np.array([np.array(list(map(int, box.split(',')))) for box in cors], dtype=int)
+        augment = utils_image.Augment(img_path=image_file_path, boxes=cors,
+                                      img_info_list=img_info_list, rng=rng, policy=policy,
+                                      new_shape=input_shape, normalize=normalize)
+    elif isinstance(sample[0], str):
+        image_file_path, cors = sample
+        augment = utils_image.Augment(img_path=image_file_path, boxes=cors,
+                                      img_info_list=img_info_list, rng=rng, policy=policy,
+                                      new_shape=input_shape, normalize=normalize)
+    else:
+        img, cors = sample
+        augment = utils_image.Augment(img=img, boxes=cors, img_info_list=img_info_list, rng=rng, policy=policy,
+                                      new_shape=input_shape, normalize=normalize)
+    new_image, new_box = augment()
+    # mixup and mosaic may bring more boxes than max_boxes
+    new_box = np.reshape(new_box, (-1, 5))[:max_boxes]
+    new_box = np.concatenate([new_box, np.zeros(shape=(max_boxes - len(new_box), 5))])
+    return new_image, new_box
+
+
+def data_generator(label_lines, batch_size, input_shape, anchors, num_classes, seed=None, batch_augment=False,
+                   uint8_input=False, input_shapes=None, scale_interval=10, encode=True, max_boxes=20):
     """
 
     :param label_lines:         record with file path and annotations,
@@ -77,38 +164,413 @@ def data_generator(label_lines, batch_size, input_shape, anchors, num_classes):
                                     /Users/robbe/others/tf_data/voc2007/images/000012.jpg 156,97,351,270,6
                                 /Users/robbe/others/tf_data/voc2007/images/000017.jpg   point to the absolute path name of an image
                                 156,97,351,270,6    means that object's box(es) are xmin=156, ymin=97, xmax=351, ymax=270 which labeled with class-id 6
+                                or a tools.utils_data.AnnotationIndex / ShardReader.
+                                label lines are parsed into an AnnotationIndex once
     :param batch_size:          batch size
     :param input_shape:         images' input shape, generally we use 608 or 416
     :param anchors:             all the anchors
     :param num_classes:         total count of classes, value of voc is 20
+    :param seed:                seed of shuffling and augment, None for a random one.
+                                with the same seed, batches are the same as parallel_data_generator's
+    :param batch_augment:       True to run flip, colors and normalization on the stacked batch
+                                (utils_image.BatchAugment) instead of per sample
+    :param uint8_input:         True to yield raw uint8 images, for models.YOLO(uint8_input=True)
+    :param input_shapes:        multi-scale training, every scale_interval batches the input shape (and the grid of
+                                y_true) is switched to one of input_shapes, see batch_input_shape
+    :param scale_interval:      count of batches between two switches
+    :param encode:              False to yield the padded boxes (batch_size, max_boxes, 5) instead of the dense y_true
+                                grids, they are encoded in graph by loss.yolo4_box_loss
+    :param max_boxes:           boxes per image after padding, keep it config.max_boxes as the loss assumes
     :return:
     """
 
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31)
+    rng = np.random.RandomState(seed)
+    if isinstance(label_lines, (list, tuple)):
+        label_lines = utils_data.AnnotationIndex.from_lines(label_lines)
+    batch_augment = utils_image.BatchAugment(normalize=not uint8_input) if batch_augment else None
+    policy = batch_augment.sample_policy if batch_augment else None
+    normalize = batch_augment is None and not uint8_input
+    if input_shapes:
+        check_input_shapes(input_shapes)
     n = len(label_lines)
+    order = np.arange(n)
     i = 0
+    batch_index = 0
     while True:
+        shape = batch_input_shape(seed, batch_index, input_shape, input_shapes, scale_interval)
         image_data = []
         box_data = []
         for b in range(batch_size):
             if i == 0:
-                np.random.shuffle(label_lines)
+                rng.shuffle(order)
 
-            label_line = label_lines[i]
-            info = label_line.split()
-            image_file_path, cors = info[0], info[1:]
-            cors = np.array([np.array(list(map(int, box.split(',')))) for box in cors], dtype=int)
-            # Augment
-            new_image, new_box = utils_image.Augment(img_path=image_file_path, boxes=cors)()
-            new_box = np.concatenate([new_box, np.zeros(shape=(20 - len(new_box), 5))])
+            new_image, new_box = load_sample(label_lines[order[i]], shape, max_boxes, img_info_list=label_lines,
+                                             rng=sample_rng(seed, batch_index, b),
+                                             policy=policy, normalize=normalize)
 
             image_data.append(new_image)
             box_data.append(new_box)
 
             i = (i + 1) % n
-        image_data = np.array(image_data)
-        box_data = np.array(box_data)
-        y_true = preprocess_true_boxes(box_data, input_shape, anchors, num_classes)
-        yield [image_data, *y_true], np.zeros(batch_size)
+        # float32 (uint8) as the model takes, the same as the shared memory of parallel_data_generator
+        image_data = np.array(image_data, dtype='uint8' if uint8_input else 'float32')
+        box_data = np.array(box_data, dtype='float32')
+        if batch_augment:
+            image_data, box_data = batch_augment(image_data, box_data, batch_rng(seed, batch_index))
+        batch_index += 1
+        if not encode:
+            yield (image_data, box_data), np.zeros(batch_size)
+            continue
+        y_true = preprocess_true_boxes(box_data, shape, anchors, num_classes)
+        yield (image_data, *y_true), np.zeros(batch_size)
+
+
+def _loader_worker(task_queue, done_queue, slot_names, label_lines, batch_size, max_boxes,
+                   batch_augment=False, uint8_input=False):
+    """
+    worker process of parallel_data_generator.
+    every task is (batch_index, slot, seed, input_shape, indexes), the decoded batch is written into the head of
+    shared memory slot, which is large enough for the largest input shape
+    """
+    box_shape = (batch_size, max_boxes, 5)
+    slots = []
+    for image_name, box_name in slot_names:
+        slots.append((shared_memory.SharedMemory(name=image_name), shared_memory.SharedMemory(name=box_name)))
+    batch_augment = utils_image.BatchAugment(normalize=not uint8_input) if batch_augment else None
+    policy = batch_augment.sample_policy if batch_augment else None
+    normalize = batch_augment is None and not uint8_input
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            batch_index, slot, seed, input_shape, indexes = task
+            image_shm, box_shm = slots[slot]
+            image_data = np.ndarray((batch_size, *input_shape, 3), dtype='uint8' if uint8_input else 'float32',
+                                    buffer=image_shm.buf)
+            box_data = np.ndarray(box_shape, dtype='float32', buffer=box_shm.buf)
+            try:
+                for b, index in enumerate(indexes):
+                    image_data[b], box_data[b] = load_sample(label_lines[index], input_shape, max_boxes,
+                                                             img_info_list=label_lines,
+                                                             rng=sample_rng(seed, batch_index, b),
+                                                             policy=policy, normalize=normalize)
+                if batch_augment:
+                    image_data[:], box_data[:] = batch_augment(image_data, box_data, batch_rng(seed, batch_index))
+            except Exception:
+                done_queue.put((batch_index, slot, traceback.format_exc()))
+                continue
+            done_queue.put((batch_index, slot, None))
+            del image_data, box_data
+    finally:
+        for image_shm, box_shm in slots:
+            image_shm.close()
+            box_shm.close()
+
+
+def parallel_data_generator(label_lines, batch_size, input_shape, anchors, num_classes,
+                            workers=4, prefetch=4, seed=None, max_boxes=20, batch_augment=False,
+                            uint8_input=False, input_shapes=None, scale_interval=10, encode=True):
+    """
+
+    same as data_generator, but samples are decoded and augmented by a pool of worker processes.
+    batches are exchanged through `prefetch` shared memory slots and yielded in order.
+
+    every sample gets its own random state (sample_rng), so a run is reproducible no matter
+    which worker a batch lands on, and it yields the same batches as data_generator with the same seed.
+
+    :param label_lines:         same as data_generator
+    :param batch_size:          batch size
+    :param input_shape:         images' input shape, generally we use 608 or 416
+    :param anchors:             all the anchors
+    :param num_classes:         total count of classes, value of voc is 20
+    :param workers:             count of worker processes
+    :param prefetch:            count of batches in flight
+    :param seed:                base seed, None for a random one
+    :param max_boxes:           boxes per image after padding
+    :param batch_augment:       same as data_generator, run by the worker on its whole batch
+    :param uint8_input:         same as data_generator, shared memory slots then hold uint8 images
+    :param input_shapes:        same as data_generator
+    :param scale_interval:      same as data_generator
+    :param encode:              same as data_generator
+    :return:
+    """
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31)
+    rng = np.random.RandomState(seed)
+    if isinstance(label_lines, (list, tuple)):
+        label_lines = utils_data.AnnotationIndex.from_lines(label_lines)
+    n = len(label_lines)
+    prefetch = max(prefetch, 1)
+
+    if input_shapes:
+        check_input_shapes(input_shapes)
+    # slots are allocated for the largest shape, smaller batches use the head of them
+    max_h, max_w = np.max([input_shape, *(input_shapes or [])], axis=0)
+    image_dtype = np.dtype('uint8' if uint8_input else 'float32')
+    box_shape = (batch_size, max_boxes, 5)
+    shms = []
+    slot_names = []
+    for _ in range(prefetch):
+        image_shm = shared_memory.SharedMemory(create=True,
+                                               size=int(batch_size * max_h * max_w * 3) * image_dtype.itemsize)
+        box_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(box_shape)) * 4)
+        shms.append((image_shm, box_shm))
+        slot_names.append((image_shm.name, box_shm.name))
+
+    task_queue = multiprocessing.Queue()
+    done_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_loader_worker,
+                                         args=(task_queue, done_queue, slot_names, label_lines,
+                                               batch_size, max_boxes, batch_augment, uint8_input),
+                                         daemon=True)
+                 for _ in range(workers)]
+    for p in processes:
+        p.start()
+
+    def batch_indexes():
+        order = np.arange(n)
+        i = 0
+        while True:
+            indexes = []
+            for b in range(batch_size):
+                if i == 0:
+                    rng.shuffle(order)
+                indexes.append(order[i])
+                i = (i + 1) % n
+            yield indexes
+
+    def task(index, slot):
+        return index, slot, seed, batch_input_shape(seed, index, input_shape, input_shapes, scale_interval), \
+            next(indexes_iter)
+
+    indexes_iter = batch_indexes()
+    try:
+        for slot in range(prefetch):
+            task_queue.put(task(slot, slot))
+        batch_index = 0
+        ready = {}
+        while True:
+            while batch_index not in ready:
+                try:
+                    index, slot, error = done_queue.get(timeout=1)
+                except queue.Empty:
+                    # 进程被杀(如OOM)时不会回报错误, 检查存活避免一直等待
+                    for p in processes:
+                        if not p.is_alive():
+                            raise RuntimeError('loader worker {} exited with code {}'.format(p.pid, p.exitcode))
+                    continue
+                if error:
+                    raise RuntimeError('loader worker failed on batch {}:\n{}'.format(index, error))
+                ready[index] = slot
+            slot = ready.pop(batch_index)
+            shape = batch_input_shape(seed, batch_index, input_shape, input_shapes, scale_interval)
+            image_shm, box_shm = shms[slot]
+            image_data = np.ndarray((batch_size, *shape, 3), dtype=image_dtype, buffer=image_shm.buf).copy()
+            box_data = np.ndarray(box_shape, dtype='float32', buffer=box_shm.buf).copy()
+            task_queue.put(task(batch_index + prefetch, slot))
+            batch_index += 1
+
+            if not encode:
+                yield (image_data, box_data), np.zeros(batch_size)
+                continue
+            y_true = preprocess_true_boxes(box_data, shape, anchors, num_classes)
+            yield (image_data, *y_true), np.zeros(batch_size)
+    finally:
+        for _ in processes:
+            task_queue.put(None)
+        for p in processes:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+        for image_shm, box_shm in shms:
+            image_shm.close()
+            box_shm.close()
+            image_shm.unlink()
+            box_shm.unlink()
+
+
+def _tf_encode_boxes(boxes, input_shape, anchors, num_classes, max_boxes=20):
+    """
+    graph version of preprocess_true_boxes for a single image
+
+    :param boxes:           (K, 5) float32, pixel x1, y1, x2, y2, class_id
+    :param input_shape:     (h, w) python ints
+    :param anchors:         (9, 2)
+    :param num_classes:     ...
+    :param max_boxes:       only the first max_boxes valid boxes are encoded, the same as load_sample
+    :return:                y_true of every layer, (h // s, w // s, 3, 5 + num_classes)
+    """
+    num_layers = len(anchors) // 3
+    h, w = input_shape
+    anchors = np.asarray(anchors, dtype='float32')
+
+    # loss.yolo4_loss的ignore mask假设每张图最多max_boxes个目标
+    boxes = tf.boolean_mask(boxes, boxes[:, 2] - boxes[:, 0] > 0)[:max_boxes]
+    boxes_xy = tf.math.floordiv(boxes[:, 0:2] + boxes[:, 2:4], 2.)
+    boxes_wh = boxes[:, 2:4] - boxes[:, 0:2]
+    rela_xy = boxes_xy / [w, h]
+    rela_wh = boxes_wh / [w, h]
+
+    # (K, 9)
+    intersect_wh = tf.minimum(boxes_wh[:, None, :], anchors[None, ...])
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    box_area = boxes_wh[:, 0:1] * boxes_wh[:, 1:2]
+    anchor_area = anchors[None, :, 0] * anchors[None, :, 1]
+    iou = intersect_area / (box_area + anchor_area - intersect_area)
+    best_anchor_indexes = tf.argmax(iou, axis=-1, output_type=tf.int32)
+
+    class_indexes = tf.cast(boxes[:, 4], tf.int32)
+    y_true = []
+    for l in range(num_layers):
+        grid_h, grid_w = h // config.scale_size[l], w // config.scale_size[l]
+        num_layer_anchors = len(config.anchor_mask[l])
+
+        k_table = np.full(len(anchors), -1, dtype='int32')
+        k_table[config.anchor_mask[l]] = np.arange(num_layer_anchors)
+        k = tf.gather(k_table, best_anchor_indexes)
+        layer_mask = k >= 0
+
+        k = tf.boolean_mask(k, layer_mask)
+        xy = tf.boolean_mask(rela_xy, layer_mask)
+        wh = tf.boolean_mask(rela_wh, layer_mask)
+        c = tf.boolean_mask(class_indexes, layer_mask)
+        # 与preprocess_true_boxes一致, 在float64下取整
+        i = tf.cast(tf.floor(tf.cast(xy[:, 0], tf.float64) * grid_w), tf.int32)
+        j = tf.cast(tf.floor(tf.cast(xy[:, 1], tf.float64) * grid_h), tf.int32)
+        indexes = tf.stack([j, i, k], axis=-1)
+
+        box_true = tf.tensor_scatter_nd_update(tf.zeros((grid_h, grid_w, num_layer_anchors, 5)),
+                                               indexes,
+                                               tf.concat([xy, wh, tf.ones_like(xy[:, 0:1])], axis=-1))
+        # 同一格子命中多个box时, 各类别位都置1
+        class_true = tf.scatter_nd(indexes,
+                                   tf.one_hot(c, num_classes),
+                                   (grid_h, grid_w, num_layer_anchors, num_classes))
+        y_true.append(tf.concat([box_true, tf.minimum(class_true, 1.)], axis=-1))
+    return y_true
+
+
+def _tf_augment(image, boxes, input_shape):
+    """
+    graph version of the flip, resize and colors parts of utils_image.Augment, with probabilities and params
+    from config.augment_policy
+
+    :param image:           (h, w, 3) uint8, BGR like cv.imread
+    :param boxes:           (K, 5) float32
+    :param input_shape:     (h, w) python ints
+    :return:                (h, w, 3) float32 in [0, 1], boxes
+    """
+    bg_h, bg_w = input_shape
+    shape = tf.shape(image)
+    h, w = tf.cast(shape[0], tf.float32), tf.cast(shape[1], tf.float32)
+    image = tf.cast(image, tf.float32)
+    x1, y1, x2, y2, class_id = tf.unstack(boxes, axis=-1)
+    policy = config.augment_policy
+    flip_policy = policy.get('flip', {'p': 0.})
+    resize_policy = policy.get('resize', {})
+    colors_policy = policy.get('colors', {'p': 0.})
+
+    # flip, flip_code in flip_codes
+    flip_codes = tf.constant(flip_policy.get('flip_codes', (-1, 0, 1)), tf.int32)
+    flip_code = tf.random.shuffle(flip_codes)[0]
+    do_flip = tf.random.uniform(()) < flip_policy.get('p', 1.)
+    flip_x = tf.logical_and(do_flip, tf.not_equal(flip_code, 0))
+    flip_y = tf.logical_and(do_flip, tf.not_equal(flip_code, 1))
+    image = tf.cond(flip_x, lambda: image[:, ::-1], lambda: image)
+    image = tf.cond(flip_y, lambda: image[::-1], lambda: image)
+    x1, x2 = tf.where(flip_x, w - x2, x1), tf.where(flip_x, w - x1, x2)
+    y1, y2 = tf.where(flip_y, h - y2, y1), tf.where(flip_y, h - y1, y2)
+
+    # resize, always, ratio in scale then paste into the center of a random color background
+    ratio = tf.random.uniform((2,), *resize_policy.get('scale', (0.5, 1.5)))
+    new_h = tf.minimum(tf.math.ceil(h * ratio[1]), bg_h)
+    new_w = tf.minimum(tf.math.ceil(w * ratio[0]), bg_w)
+    dh = tf.math.floordiv(bg_h - new_h, 2.)
+    dw = tf.math.floordiv(bg_w - new_w, 2.)
+    color = tf.random.uniform((1, 1, 3), 0, 256, dtype=tf.int32)
+    color = tf.cast(color, tf.float32)
+    image = tf.image.resize(image, tf.cast(tf.stack([new_h, new_w]), tf.int32), method='bicubic')
+    image = tf.image.pad_to_bounding_box(image - color, tf.cast(dh, tf.int32), tf.cast(dw, tf.int32), bg_h, bg_w)
+    image = image + color
+    x1 = tf.clip_by_value(x1 * new_w / w + dw, 0, bg_w - 1)
+    x2 = tf.clip_by_value(x2 * new_w / w + dw, 0, bg_w - 1)
+    y1 = tf.clip_by_value(y1 * new_h / h + dh, 0, bg_h - 1)
+    y2 = tf.clip_by_value(y2 * new_h / h + dh, 0, bg_h - 1)
+    boxes = tf.round(tf.stack([x1, y1, x2, y2, class_id], axis=-1))
+
+    # colors
+    image = tf.clip_by_value(image, 0, 255) / 255.
+    hue_range = colors_policy.get('hue', config.hue)
+    sat_range = colors_policy.get('sat', config.sat)
+    val_range = colors_policy.get('val', config.val)
+
+    def colors():
+        hue = tf.random.uniform((), -hue_range, hue_range)
+        sat = tf.random.uniform((), 1, sat_range)
+        sat = tf.where(tf.random.uniform(()) < .5, sat, 1 / sat)
+        val = tf.random.uniform((), 1, val_range)
+        val = tf.where(tf.random.uniform(()) < .5, val, 1 / val)
+        x = tf.image.rgb_to_hsv(image)
+        x = tf.stack([tf.math.floormod(x[..., 0] + hue, 1.), x[..., 1] * sat, x[..., 2] * val], axis=-1)
+        return tf.image.hsv_to_rgb(tf.clip_by_value(x, 0, 1))
+
+    image = tf.cond(tf.random.uniform(()) < colors_policy.get('p', 1.), colors, lambda: image)
+    return image, boxes
+
+
+def tf_data_generator(label_lines, batch_size, input_shape, anchors, num_classes, uint8_input=False, encode=True,
+                      max_boxes=20, seed=None, batch_augment=False):
+    """
+
+    tf.data version of data_generator. decoding, flip/resize/colors augment and
+    target encoding all run as graph ops in an autotuned parallel map.
+    rotate, pixel, mixup and mosaic are only available in data_generator.
+
+    :param label_lines:         label lines, same format as data_generator
+    :param batch_size:          batch size
+    :param input_shape:         images' input shape, generally we use 608 or 416
+    :param anchors:             all the anchors
+    :param num_classes:         total count of classes, value of voc is 20
+    :param uint8_input:         same as data_generator
+    :param encode:              same as data_generator
+    :param max_boxes:           boxes per image after padding, or encoded into y_true when encode is True
+    :param seed:                seed of shuffling. unlike data_generator it does not fix the augment,
+                                whose graph ops draw from tf's global random state
+    :param batch_augment:       not supported, flip and colors already run as graph ops per sample
+    :return:                    tf.data.Dataset of ((image_data, *y_true), zeros),
+                                or ((image_data, box_data), zeros) when encode is False
+    """
+    assert not batch_augment, 'tf_data loader has no batch_augment, unset config.batch_augment'
+    autotune = tf.data.experimental.AUTOTUNE
+    input_shape = tuple(int(x) for x in input_shape)
+
+    def parse(label_line):
+        info = tf.strings.split(tf.strings.strip(label_line))
+        image_file_path = info[0]
+        boxes = tf.strings.to_number(tf.strings.split(info[1:], ',').flat_values, tf.float32)
+        boxes = tf.reshape(boxes, (-1, 5))
+        image = tf.io.decode_image(tf.io.read_file(image_file_path), channels=3, expand_animations=False)
+        # keep the same channel order as cv.imread
+        image = image[..., ::-1]
+        image, boxes = _tf_augment(image, boxes, input_shape)
+        if uint8_input:
+            image = tf.cast(tf.round(image * 255.), tf.uint8)
+        if not encode:
+            boxes = tf.boolean_mask(boxes, boxes[:, 2] - boxes[:, 0] > 0)[:max_boxes]
+            boxes = tf.pad(boxes, [[0, max_boxes - tf.shape(boxes)[0]], [0, 0]])
+            return (image, tf.ensure_shape(boxes, (max_boxes, 5))), 0.
+        y_true = _tf_encode_boxes(boxes, input_shape, anchors, num_classes, max_boxes)
+        return (image, *y_true), 0.
+
+    dataset = tf.data.Dataset.from_tensor_slices([line.strip() for line in label_lines])
+    dataset = dataset.shuffle(len(label_lines), seed=seed, reshuffle_each_iteration=True).repeat()
+    dataset = dataset.map(parse, num_parallel_calls=autotune)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    return dataset.prefetch(autotune)
+
 
 if __name__ == '__main__':
    a = data_generator(['/Users/robbe/others/tf_data/voc2007/images/009819.jpg 369,34,465,188,8 232,51,383,267,7',
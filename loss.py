@@ -1,3 +1,4 @@
+import math
 import tensorflow.keras.backend as K
 import tensorflow as tf
 import numpy as np
@@ -85,8 +86,10 @@ def yolo4_loss(args):
     loss = 0
 
     anchors, num_classes, ignore_thresh = config.anchors, config.num_classes, config.ignore_thresh
+    max_boxes = config.max_boxes
 
-    y_pred_base, y_true = args[:3], args[3:]
+    # 混合精度下网络输出也按float32计算loss
+    y_pred_base, y_true = [K.cast(y_pred, K.floatx()) for y_pred in args[:3]], args[3:]
     # 3
     num_layers = len(anchors) // 3  # default setting
     # (9, 2)
@@ -104,7 +107,7 @@ def yolo4_loss(args):
         object_mask = y_true[l][..., 4:5]
         true_class_probs = y_true[l][..., 5:]
 
-        grid, raw_pred, pred_xy, pred_wh = YOLO().yolo_head(y_pred_base[l],
+        grid, raw_pred, pred_xy, pred_wh = YOLO.yolo_head(y_pred_base[l],
                                                      anchors[config.anchor_mask[l]],
                                                      num_classes,
                                                      input_shape,
@@ -116,20 +119,20 @@ def yolo4_loss(args):
         # raw_true_wh = K.switch(object_mask, raw_true_wh, K.zeros_like(raw_true_wh))  # avoid log(0)=-inf
         box_loss_scale = 2 - y_true[l][..., 2:3] * y_true[l][..., 3:4]
 
-        ignore_mask = tf.TensorArray(K.dtype(y_true[0]), size=1, dynamic_size=True)
-        object_mask_bool = K.cast(object_mask, 'bool')
-
-        def loop_body(b, ignore_mask):
-            true_box = tf.boolean_mask(y_true[l][b, ..., 0:4], object_mask_bool[b, ..., 0])
-            iou = utils.iou_cors_index(pred_box[b], true_box)
-            best_iou = K.max(iou, axis=-1)
-            ignore_mask = ignore_mask.write(b, K.cast(best_iou < ignore_thresh, K.dtype(true_box)))
-            return b + 1, ignore_mask
-
-        _, ignore_mask = tf.while_loop(lambda b, *args: b < batch, loop_body, [0, ignore_mask])
-
-        ignore_mask = ignore_mask.stack()
-        ignore_mask = K.expand_dims(ignore_mask, -1)
+        # ignore mask of the whole batch at once: the objects of every image are padded to max_boxes,
+        # then the iou of every predicted box against them is one broadcast op.
+        # every loader keeps at most config.max_boxes boxes per image (load_sample, _tf_encode_boxes,
+        # encode_true_boxes), so no object is left out. k stays static for XLA
+        object_flat = K.reshape(object_mask, (batch, -1))
+        # indexes of the first max_boxes objects of every image, padding slots point to non-object cells
+        object_valid, object_index = tf.math.top_k(object_flat, k=K.minimum(max_boxes, K.shape(object_flat)[1]),
+                                                   sorted=True)
+        true_box = tf.gather(K.reshape(y_true[l][..., 0:4], (batch, -1, 4)), object_index, batch_dims=1)
+        # (N, h, w, 3, max_boxes)
+        iou = utils.batch_iou_cors(pred_box, true_box)
+        iou = tf.where(K.reshape(object_valid, (batch, 1, 1, 1, -1)) > 0, iou, K.zeros_like(iou))
+        best_iou = K.max(iou, axis=-1)
+        ignore_mask = K.expand_dims(K.cast(best_iou < ignore_thresh, K.dtype(y_true[0])), -1)
 
         confidence_loss = object_mask * K.binary_crossentropy(object_mask, raw_pred[..., 4:5], from_logits=True) + \
                               (1 - object_mask) * K.binary_crossentropy(object_mask, raw_pred[..., 4:5],
@@ -155,3 +158,78 @@ def yolo4_loss(args):
     loss = K.expand_dims(loss, axis=-1)
 
     return loss
+
+
+def encode_true_boxes(true_boxes, input_shape, grid_shapes, anchors, num_classes):
+    """
+    graph version of generator.preprocess_true_boxes for a whole batch, the input shape may change per batch
+
+    :param true_boxes:      (N, max_boxes, 5) pixel x1, y1, x2, y2, class_id, padded with zeros
+    :param input_shape:     (2, ) int tensor, (h, w)
+    :param grid_shapes:     [(2, ) int tensor, ...] (h, w) of every layer
+    :param anchors:         (9, 2)
+    :param num_classes:
+    :return:                y_true of every layer, (N, h, w, 3, 5 + num_classes)
+    """
+    batch = tf.shape(true_boxes)[0]
+    true_boxes = tf.cast(true_boxes, tf.float32)
+    input_wh = tf.cast(input_shape[::-1], tf.float64)
+
+    boxes_xy = tf.math.floordiv(true_boxes[..., 0:2] + true_boxes[..., 2:4], 2.)
+    boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
+    # 与preprocess_true_boxes一致, 在float64下计算再转为float32
+    rela_xy = tf.cast(tf.cast(boxes_xy, tf.float64) / input_wh, tf.float32)
+    rela_wh = tf.cast(tf.cast(boxes_wh, tf.float64) / input_wh, tf.float32)
+
+    # (N, max_boxes, 9) iou of centered boxes and anchors
+    anchors = np.asarray(anchors, dtype='float64')
+    wh = tf.cast(boxes_wh, tf.float64)[..., None, :]
+    intersect_wh = tf.minimum(wh, anchors)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    iou = intersect_area / (wh[..., 0] * wh[..., 1] + anchors[:, 0] * anchors[:, 1] - intersect_area)
+    best_anchor_indexes = tf.argmax(iou, axis=-1, output_type=tf.int32)
+    valid_mask = boxes_wh[..., 0] > 0
+
+    y_true = []
+    for l in range(len(grid_shapes)):
+        grid_h, grid_w = grid_shapes[l][0], grid_shapes[l][1]
+        num_layer_anchors = len(config.anchor_mask[l])
+        # anchor序号 -> 该层内的序号k, 不属于该层的为-1
+        k_table = np.full(len(anchors), -1, dtype='int32')
+        k_table[config.anchor_mask[l]] = np.arange(num_layer_anchors)
+        k = tf.gather(k_table, best_anchor_indexes)
+
+        # (x, 2) batch and box index of the boxes of this layer
+        box_indexes = tf.where(tf.logical_and(valid_mask, k >= 0))
+        k = tf.gather_nd(k, box_indexes)
+        xy = tf.gather_nd(rela_xy, box_indexes)
+        wh = tf.gather_nd(rela_wh, box_indexes)
+        c = tf.cast(tf.gather_nd(true_boxes[..., 4], box_indexes), tf.int32)
+        i = tf.cast(tf.floor(tf.cast(xy[:, 0], tf.float64) * tf.cast(grid_w, tf.float64)), tf.int32)
+        j = tf.cast(tf.floor(tf.cast(xy[:, 1], tf.float64) * tf.cast(grid_h, tf.float64)), tf.int32)
+        indexes = tf.stack([tf.cast(box_indexes[:, 0], tf.int32), j, i, k], axis=-1)
+
+        box_true = tf.tensor_scatter_nd_update(tf.zeros(tf.stack([batch, grid_h, grid_w, num_layer_anchors, 5])),
+                                               indexes,
+                                               tf.concat([xy, wh, tf.ones_like(xy[:, 0:1])], axis=-1))
+        # 同一格子命中多个box时, 各类别位都置1
+        class_true = tf.scatter_nd(indexes,
+                                   tf.one_hot(c, num_classes),
+                                   tf.stack([batch, grid_h, grid_w, num_layer_anchors, num_classes]))
+        y_true.append(tf.concat([box_true, tf.minimum(class_true, 1.)], axis=-1))
+    return y_true
+
+
+def yolo4_box_loss(args):
+    """
+    same as yolo4_loss, but takes the compact ground truth instead of dense y_true grids,
+    which are built in graph by encode_true_boxes
+
+    :param args:        [*yolo_outputs, true_boxes (N, max_boxes, 5)]
+    :return:            loss, shape=(1,)
+    """
+    y_pred_base, true_boxes = args[:3], args[3]
+    grid_shapes = [tf.shape(y_pred_base[l])[1:3] for l in range(3)]
+    input_shape = grid_shapes[0] * 32
+    y_true = encode_true_boxes(true_boxes, input_shape, grid_shapes, config.anchors, config.num_classes)
+    return yolo4_loss([*y_pred_base, *y_true])
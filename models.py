@@ -1,58 +1,223 @@
 from tensorflow import keras
+import tensorflow as tf
 import tensorflow.keras.backend as K
 from functools import reduce
+import contextlib
 import config
 import numpy as np
 from tools import utils
 
 
+def tanh_softplus(x, fast=False):
+    """
+    tanh(softplus(x)). with fast it is (e^2x + 2e^x) / (e^2x + 2e^x + 2), one exp instead of exp, log1p and tanh,
+    equal in math but rounded differently
+    """
+    if not fast:
+        return tf.tanh(tf.math.softplus(x))
+    e = tf.exp(x)
+    n = e * (e + 2.)
+    # n溢出为inf时(float16下x > 5.5)用1 - 2 / (n + 2)
+    return tf.where(x < 5., n / (n + 2.), 1. - 2. / (n + 2.))
+
+
+def mish(x, fast=False):
+    """
+    mish(x) = x * tanh(softplus(x)), only x is kept for backprop and the derivative is recomputed from it:
+        mish'(x) = tanh(softplus(x)) + x * sigmoid(x) * (1 - tanh(softplus(x)) ^ 2)
+    """
+
+    @tf.custom_gradient
+    def _mish(x):
+        def grad(dy):
+            t = tanh_softplus(x, fast)
+            return dy * (t + x * tf.sigmoid(x) * (1. - t * t))
+
+        return x * tanh_softplus(x, fast), grad
+
+    return _mish(x)
+
+
 class Mish(keras.layers.Layer):
     """
     Mish Activation Function.
     .. math::
         mish(x) = x * tanh(softplus(x)) = x * tanh(ln(1 + e^{x}))
+
+    the gradient is recomputed from the input instead of keeping softplus and tanh for backprop, see mish.
+    fast=True uses the one-exp form of tanh_softplus, for inference
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, fast=False, **kwargs):
         super(Mish, self).__init__(**kwargs)
         self.supports_masking = True
+        self.fast = fast
 
     def call(self, inputs):
-        return inputs * K.tanh(K.softplus(inputs))
+        return mish(inputs, self.fast)
 
     def get_config(self):
         custom_config = super(Mish, self).get_config()
+        custom_config.update({'fast': self.fast})
         return custom_config
 
     def compute_output_shape(self, input_shape):
         return input_shape
 
 
+class YoloPostprocess(keras.layers.Layer):
+    """
+    decode -> correct boxes -> combined nms, all in graph.
+    inputs are the 3 raw outputs of yolo and the raw (h, w) of every image,
+    outputs are boxes (N, max_total_boxes, 4) as y_min, x_min, y_max, x_max in raw image pixels,
+    scores (N, max_total_boxes), classes (N, max_total_boxes) and valid_detections (N, )
+    """
+
+    def __init__(self,
+                 anchors,
+                 num_classes,
+                 max_boxes=100,
+                 max_total_boxes=100,
+                 score_threshold=.6,
+                 iou_threshold=.5,
+                 **kwargs):
+        super(YoloPostprocess, self).__init__(**kwargs)
+        self.anchors = np.asarray(anchors, dtype='float32').tolist()
+        self.num_classes = num_classes
+        self.max_boxes = max_boxes
+        self.max_total_boxes = max_total_boxes
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+
+    def call(self, inputs):
+        yolo_outputs, image_shape = inputs[:-1], inputs[-1]
+        anchors = np.asarray(self.anchors, dtype='float32')
+        dtype = yolo_outputs[0].dtype
+        batch = tf.shape(yolo_outputs[0])[0]
+        input_shape = tf.cast(tf.shape(yolo_outputs[0])[1:3] * 32, dtype)
+        image_shape = tf.reshape(tf.cast(image_shape, dtype), [-1, 1, 2])
+
+        boxes = []
+        box_scores = []
+        for l in range(len(yolo_outputs)):
+            layer_anchors = anchors[config.anchor_mask[l]]
+            num_anchors = len(layer_anchors)
+            grid_shape = tf.shape(yolo_outputs[l])[1:3]
+            grid_y, grid_x = tf.meshgrid(tf.range(grid_shape[0]), tf.range(grid_shape[1]), indexing='ij')
+            grid = tf.cast(tf.stack([grid_x, grid_y], axis=-1), dtype)
+            grid = tf.reshape(tf.tile(grid[:, :, None, :], [1, 1, num_anchors, 1]), [1, -1, 2])
+            layer_anchors = tf.reshape(tf.tile(layer_anchors[None, :, :], [grid_shape[0] * grid_shape[1], 1, 1]),
+                                       [1, -1, 2])
+
+            feats = tf.reshape(yolo_outputs[l], [batch, -1, self.num_classes + 5])
+            box_xy = (tf.sigmoid(feats[..., :2]) + grid) / tf.cast(grid_shape[::-1], dtype)
+            box_wh = tf.exp(feats[..., 2:4]) * tf.cast(layer_anchors, dtype) / input_shape[::-1]
+            boxes.append(self.correct_boxes(box_xy, box_wh, input_shape, image_shape))
+            box_scores.append(tf.sigmoid(feats[..., 4:5]) * tf.sigmoid(feats[..., 5:]))
+
+        boxes = tf.concat(boxes, axis=1)
+        box_scores = tf.concat(box_scores, axis=1)
+        nms_boxes, nms_scores, nms_classes, valid_detections = tf.image.combined_non_max_suppression(
+            boxes[:, :, None, :],
+            box_scores,
+            max_output_size_per_class=self.max_boxes,
+            max_total_size=self.max_total_boxes,
+            iou_threshold=self.iou_threshold,
+            score_threshold=self.score_threshold,
+            clip_boxes=False)
+        return nms_boxes, nms_scores, tf.cast(nms_classes, 'int32'), valid_detections
+
+    @staticmethod
+    def correct_boxes(box_xy, box_wh, input_shape, image_shape):
+        """
+        graph version of eval.yolo_correct_boxes
+        """
+        box_yx = box_xy[..., ::-1]
+        box_hw = box_wh[..., ::-1]
+        new_shape = tf.round(image_shape * tf.reduce_min(input_shape / image_shape, axis=-1, keepdims=True))
+        offset = (input_shape - new_shape) / 2. / input_shape
+        scale = input_shape / new_shape
+        box_yx = (box_yx - offset) * scale
+        box_hw = box_hw * scale
+        boxes = tf.concat([box_yx - box_hw / 2., box_yx + box_hw / 2.], axis=-1)
+        return boxes * tf.concat([image_shape, image_shape], axis=-1)
+
+    def get_config(self):
+        custom_config = super(YoloPostprocess, self).get_config()
+        custom_config.update({'anchors': self.anchors,
+                              'num_classes': self.num_classes,
+                              'max_boxes': self.max_boxes,
+                              'max_total_boxes': self.max_total_boxes,
+                              'score_threshold': self.score_threshold,
+                              'iou_threshold': self.iou_threshold})
+        return custom_config
+
+
 class YOLO:
     def __init__(self,
                  input_shape=(None, None),
                  pre_train: str = None,
-                 freeze_num: int = 2):
+                 freeze_num: int = 2,
+                 postprocess: bool = False,
+                 uint8_input: bool = False,
+                 precision: str = 'float32',
+                 fast_mish: bool = False):
+        """
+
+        :param input_shape:
+        :param pre_train:       weights file path
+        :param freeze_num:      1 freeze darknet, 2 freeze all but the last 3 layers
+        :param postprocess:     append YoloPostprocess, the model takes [image, image_shape] and returns
+                                final boxes, scores, classes and valid_detections instead of raw feature maps.
+                                for example, to export a SavedModel serving final detections:
+                                    model = YOLO(postprocess=True)()
+                                    model.load_weights('model_train/yolov4.h5')
+                                    tf.saved_model.save(model, 'model_train/yolov4_export')
+        :param uint8_input:     the model takes raw uint8 images and rescales them to [0, 1] in graph,
+                                so loaders feed 4-8x fewer bytes. weights are the same either way
+        :param precision:       keras dtype policy of the network, 'mixed_bfloat16' (CPU) or 'mixed_float16' (GPU,
+                                train with keras.mixed_precision.LossScaleOptimizer) halve the activation memory.
+                                variables, the 3 output convs and postprocess stay float32, so the loss and
+                                decode always see float32 feature maps. weights are the same either way
+        :param fast_mish:       Mish(fast=True) in darknet, faster for inference. weights are the same either way
+        """
         self.num_classes = config.num_classes
         self.num_anchors = config.num_anchors
-        self.inputs = keras.layers.Input((*input_shape, 3))
-        self.darknet = self.get_darknet()
-        self.darknet_model = keras.models.Model(self.inputs, self.darknet)
-        self.y1 = self.darknet_model.layers[-1].output
-        self.y2 = self.darknet_model.layers[204].output
-        self.y3 = self.darknet_model.layers[131].output
-        self.spp = self.get_spp()
-        self.pan = self.get_pan()
+        self.fast_mish = fast_mish
+        self.inputs = keras.layers.Input((*input_shape, 3), dtype='uint8' if uint8_input else 'float32')
+        with dtype_policy(precision):
+            if uint8_input:
+                self.images = keras.layers.Lambda(lambda x: K.cast(x, K.floatx()) / 255., name='rescale')(self.inputs)
+            else:
+                self.images = self.inputs
+            # the rescale layer shifts the darknet layer indexes below
+            offset = int(uint8_input)
+            self.darknet = self.get_darknet()
+            self.darknet_model = keras.models.Model(self.inputs, self.darknet)
+            self.y1 = self.darknet_model.layers[-1].output
+            self.y2 = self.darknet_model.layers[204 + offset].output
+            self.y3 = self.darknet_model.layers[131 + offset].output
+            self.spp = self.get_spp()
+            self.pan = self.get_pan()
         self.yolo = keras.models.Model(self.inputs, [*self.pan])
         if pre_train:
             print('loading pre-weights file ...')
             self.yolo.load_weights(pre_train, by_name=True, skip_mismatch=True)
-            num = (250, len(self.yolo.layers) - 3)[freeze_num - 1]
+            num = (250 + offset, len(self.yolo.layers) - 3)[freeze_num - 1]
             for i in range(num):
                 self.yolo.layers[i].trainable = False
             print('loading finished')
-
-    def conv_base_block(self, inputs, filters, kernel_size, strides=(1, 1), use_bias=True, name=None):
+        if postprocess:
+            self.image_shape = keras.layers.Input((2,), name='image_shape')
+            detections = YoloPostprocess(config.anchors,
+                                         self.num_classes,
+                                         score_threshold=config.score,
+                                         iou_threshold=config.iou,
+                                         dtype='float32',
+                                         name='yolo_postprocess')([*self.pan, self.image_shape])
+            self.yolo = keras.models.Model([self.inputs, self.image_shape], detections)
+
+    def conv_base_block(self, inputs, filters, kernel_size, strides=(1, 1), use_bias=True, name=None, dtype=None):
         """
         darknet base conv vlock
         """
@@ -66,6 +231,7 @@ class YOLO:
                                 padding=padding,
                                 use_bias=use_bias,
                                 kernel_regularizer=keras.regularizers.l2(5e-4),
+                                dtype=dtype,
                                 name=name)(inputs)
         return o
 
@@ -76,7 +242,7 @@ class YOLO:
         x = self.conv_base_block(inputs=inputs, filters=filters, kernel_size=kernel_size, strides=strides,
                                  use_bias=use_bias)
         x = keras.layers.BatchNormalization()(x)
-        o = Mish(name=name)(x)
+        o = Mish(fast=self.fast_mish, name=name)(x)
         return o
 
     def conv_leakyrelu_block(self, inputs, filters, kernel_size, strides=(1, 1), use_bias=False, name=None):
@@ -110,7 +276,7 @@ class YOLO:
         """
         darknet part
         """
-        x = self.conv_mish_block(inputs=self.inputs, filters=32, kernel_size=3)
+        x = self.conv_mish_block(inputs=self.images, filters=32, kernel_size=3)
         x = self.res_block(inputs=x, filters=64, block_num=1, shotcut=False)
         x = self.res_block(inputs=x, filters=128, block_num=2)
         x = self.res_block(inputs=x, filters=256, block_num=8)
@@ -165,7 +331,8 @@ class YOLO:
 
         # o 3
         self.o3 = self.conv_leakyrelu_block(inputs=self.y3, filters=256, kernel_size=3)
-        self.o3 = self.conv_base_block(inputs=self.o3, filters=(self.num_classes + 5) * self.num_anchors, kernel_size=1)
+        self.o3 = self.conv_base_block(inputs=self.o3, filters=(self.num_classes + 5) * self.num_anchors, kernel_size=1,
+                                        dtype='float32')
 
         # o 2
         self.y3_down = keras.layers.ZeroPadding2D(((1, 0), (1, 0)))(self.y3)
@@ -177,7 +344,8 @@ class YOLO:
         self.y2 = self.conv_leakyrelu_block(inputs=self.y2, filters=512, kernel_size=3)
         self.y2 = self.conv_leakyrelu_block(inputs=self.y2, filters=256, kernel_size=1)
         self.o2 = self.conv_leakyrelu_block(inputs=self.y2, filters=512, kernel_size=3)
-        self.o2 = self.conv_base_block(inputs=self.o2, filters=(self.num_classes + 5) * self.num_anchors, kernel_size=1)
+        self.o2 = self.conv_base_block(inputs=self.o2, filters=(self.num_classes + 5) * self.num_anchors, kernel_size=1,
+                                        dtype='float32')
 
         # o 1
         self.y2_down = keras.layers.ZeroPadding2D(((1, 0), (1, 0)))(self.y2)
@@ -189,7 +357,8 @@ class YOLO:
         self.y1 = self.conv_leakyrelu_block(inputs=self.y1, filters=1024, kernel_size=3)
         self.y1 = self.conv_leakyrelu_block(inputs=self.y1, filters=512, kernel_size=1)
         self.o1 = self.conv_leakyrelu_block(inputs=self.y1, filters=1024, kernel_size=3)
-        self.o1 = self.conv_base_block(inputs=self.o1, filters=(self.num_classes + 5) * self.num_anchors, kernel_size=1)
+        self.o1 = self.conv_base_block(inputs=self.o1, filters=(self.num_classes + 5) * self.num_anchors, kernel_size=1,
+                                        dtype='float32')
 
         o1, o2, o3 = self.o1, self.o2, self.o3
         # [x // 32, xx/ 16, xx/8]
@@ -246,6 +415,23 @@ class YOLO:
         return self.yolo
 
 
+@contextlib.contextmanager
+def dtype_policy(policy):
+    """
+    layers created inside take the given keras dtype policy, the global one is restored on exit.
+    float32 leaves the global policy untouched
+    """
+    if policy == 'float32':
+        yield
+        return
+    default_policy = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy(policy)
+    try:
+        yield
+    finally:
+        keras.mixed_precision.set_global_policy(default_policy)
+
+
 def compose(*funcs):
     """Compose arbitrarily many functions, evaluated left to right.
 
@@ -0,0 +1,77 @@
+"""
+pack a labels file into shards, which are read back by tools.utils_data.ShardReader.
+images are decoded once (and optionally resized) here, so training only does sequential reads of a few large files.
+"""
+
+import cv2 as cv
+import numpy as np
+import os
+
+
+def pack(label_path, output_prefix, shard_size=1000, max_size=0):
+    """
+
+    :param label_path:          labels file, same format as config.label_path
+    :param output_prefix:       shards are written as output_prefix-00000.bin/.npz, output_prefix-00001.bin/.npz ...
+    :param shard_size:          count of images in each shard
+    :param max_size:            if > 0, images whose longer side exceeds max_size are resized down (boxes too)
+    :return:
+    """
+    with open(label_path) as f:
+        label_lines = [line for line in f.readlines() if line.strip()]
+
+    root = os.path.dirname(output_prefix)
+    if root:
+        os.makedirs(root, exist_ok=True)
+
+    for shard_id, start in enumerate(range(0, len(label_lines), shard_size)):
+        shard_prefix = '{}-{:05d}'.format(output_prefix, shard_id)
+        image_offsets, image_shapes, box_offsets, boxes, paths = [0], [], [0], [], []
+        with open(shard_prefix + '.bin', 'wb') as f:
+            for label_line in label_lines[start: start + shard_size]:
+                info = label_line.split()
+                image_file_path, cors = info[0], info[1:]
+                cors = np.array([np.array(list(map(int, box.split(',')))) for box in cors], dtype=np.int32).reshape(-1, 5)
+                img = cv.imread(image_file_path)
+                assert img is not None, 'can not read ' + image_file_path
+
+                h, w = img.shape[:2]
+                if 0 < max_size < max(h, w):
+                    scale = max_size / max(h, w)
+                    nw, nh = max(int(round(w * scale)), 1), max(int(round(h * scale)), 1)
+                    img = cv.resize(img, (nw, nh), interpolation=cv.INTER_AREA)
+                    cors[:, [0, 2]] = np.round(cors[:, [0, 2]] * nw / w)
+                    cors[:, [1, 3]] = np.round(cors[:, [1, 3]] * nh / h)
+
+                img = np.ascontiguousarray(img, dtype=np.uint8)
+                f.write(img.tobytes())
+                image_offsets.append(image_offsets[-1] + img.size)
+                image_shapes.append(img.shape)
+                box_offsets.append(box_offsets[-1] + len(cors))
+                boxes.append(cors)
+                paths.append(image_file_path)
+
+        np.savez(shard_prefix + '.npz',
+                 image_offsets=np.asarray(image_offsets, dtype=np.int64),
+                 image_shapes=np.asarray(image_shapes, dtype=np.int32),
+                 box_offsets=np.asarray(box_offsets, dtype=np.int64),
+                 boxes=np.concatenate(boxes).astype(np.int32),
+                 paths=np.asarray(paths))
+        print('{} images -> {}'.format(len(paths), shard_prefix))
+
+
+if __name__ == '__main__':
+    import argparse
+    import config
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-l', '--labels', type=str, help='input labels file path', default=config.label_path)
+    parser.add_argument('-o', '--output', type=str, help='output shard prefix',
+                        default=config.shard_path or '/opt/voc2007/shards/voc')
+    parser.add_argument('-n', '--shard_size', type=int, help='images per shard', default=1000)
+    parser.add_argument('-s', '--max_size', type=int, help='resize longer side down to it, 0 to keep raw size',
+                        default=0)
+
+    args = parser.parse_args()
+    pack(args.labels, args.output, args.shard_size, args.max_size)
@@ -4,57 +4,118 @@ import cv2 as cv
 import numpy as np
 import eval
 import models
-import argparse
 import tensorflow as tf
 
-devices = tf.config.experimental.list_physical_devices('GPU')
-if devices:
-    tf.config.experimental.set_memory_growth(devices[0], True)
 
-
-parser = argparse.ArgumentParser()
-
-parser.add_argument('-m', '--model', type=str, help='input h5 model path', default='model_train/yolov4.h5')
-parser.add_argument('-i', '--image', type=str, help='input image file path', default='data/000030.jpg')
-
-
-args = parser.parse_args()
-model_file_path = args.model
-image_file_path = args.image
-class_file_path = config.classes_path
-
-
-anchors = config.anchors
-class_names = config.classes_names
-
-num_anchors = len(anchors)
-num_classes = len(class_names)
-class_mapping = dict(enumerate(class_names))
-colors = utils_image.get_random_colors(len(class_names))
-class_mapping = {class_mapping[key]: key for key in class_mapping}
-model = models.YOLO()()
-model.load_weights('model_train/ep155-loss13.141-valloss13.487.h5')
-
-
-
-image = cv.imread(image_file_path)
-image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
-
-
-new_image = utils_image.resize_image(image, config.image_input_shape)
-
-new_image = np.array(new_image, dtype='float32')
-new_image /= 255.
-new_image = np.expand_dims(new_image, 0)
-feats = model.predict(new_image)
-
-
-boxes, scores, classes = eval.yolo_eval(feats, anchors, len(class_names), (image.shape[0], image.shape[1]))
-out_boxes, out_scores, out_classes = boxes[:5], scores[:5], classes[:5]
-
-
-image = utils_image.draw_rectangle(image, boxes, scores, classes, class_names, colors, mode='pillow')
-image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
-cv.namedWindow("img", cv.WINDOW_NORMAL)
-cv.imshow('img', image)
-cv.waitKey()
+class Predictor:
+    """
+    load the model once and predict images of any size in batches
+
+    example:
+        predictor = Predictor('model_train/yolov4.h5', batch_size=8)
+        for boxes, scores, classes in predictor(images):
+            ...
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 input_shape=config.image_input_shape,
+                 batch_size: int = 8,
+                 score_threshold: float = config.score,
+                 iou_threshold: float = config.iou,
+                 max_boxes: int = 100,
+                 max_total_boxes: int = None,
+                 fast_mish: bool = config.fast_mish):
+        self.input_shape = input_shape
+        self.batch_size = batch_size
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.max_boxes = max_boxes
+        self.max_total_boxes = max_total_boxes
+        self.anchors = config.anchors
+        self.num_classes = config.num_classes
+        # raw uint8 letterboxed images are fed, the model rescales them in graph
+        self.model = models.YOLO(uint8_input=True, precision=config.precision, fast_mish=fast_mish)()
+        self.model.load_weights(model_path)
+        # images are letterboxed straight into this buffer, it is reused by every batch
+        self.image_data = np.empty((batch_size, *input_shape, 3), dtype='uint8')
+
+    def predict_batch(self, images):
+        """
+
+        :param images:      list of RGB images, shapes can be different
+        :return:            list of (boxes, scores, classes), one per image
+        """
+        image_data = self.image_data[:len(images)]
+        scales, offsets = zip(*[utils_image.letterbox(image, image_data[i]) for i, image in enumerate(images)])
+        feats = self.model.predict_on_batch(image_data)
+
+        batch_index, boxes, box_scores = eval.yolo_decode(feats,
+                                                          self.anchors,
+                                                          self.num_classes,
+                                                          [image.shape[:2] for image in images],
+                                                          score_threshold=self.score_threshold,
+                                                          scales=scales,
+                                                          offsets=offsets)
+        return eval.yolo_batch_nms(batch_index,
+                                   boxes,
+                                   box_scores,
+                                   len(images),
+                                   self.num_classes,
+                                   max_boxes=self.max_boxes,
+                                   score_threshold=self.score_threshold,
+                                   iou_threshold=self.iou_threshold,
+                                   max_total_boxes=self.max_total_boxes)
+
+    def predict(self, images):
+        """
+
+        :param images:      list or iterator of RGB images
+        :return:            list of (boxes, scores, classes), one per image
+        """
+        results = []
+        batch = []
+        for image in images:
+            batch.append(image)
+            if len(batch) == self.batch_size:
+                results.extend(self.predict_batch(batch))
+                batch = []
+        if batch:
+            results.extend(self.predict_batch(batch))
+        return results
+
+    def __call__(self, images):
+        return self.predict(images)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    devices = tf.config.experimental.list_physical_devices('GPU')
+    if devices:
+        tf.config.experimental.set_memory_growth(devices[0], True)
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-m', '--model', type=str, help='input h5 model path', default='model_train/yolov4.h5')
+    parser.add_argument('-i', '--image', type=str, help='input image file path', default='data/000030.jpg')
+
+    args = parser.parse_args()
+    model_file_path = args.model
+    image_file_path = args.image
+
+    class_names = config.classes_names
+    colors = utils_image.get_random_colors(len(class_names))
+
+    predictor = Predictor(model_file_path)
+
+    image = cv.imread(image_file_path)
+    image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
+
+    boxes, scores, classes = predictor([image])[0]
+
+    image = utils_image.draw_rectangle(image, boxes, scores, classes, class_names, colors, mode='pillow')
+    image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
+    cv.namedWindow("img", cv.WINDOW_NORMAL)
+    cv.imshow('img', image)
+    cv.waitKey()
@@ -3,6 +3,7 @@
 """
 
 import numpy as np
+import tensorflow as tf
 import tensorflow.keras.backend as K
 
 
@@ -45,6 +46,71 @@ def nms(boxes, scores, iou_threshold, max_boxes):
     return index
 
 
+def limit_per_group(indexes, groups, limit):
+    """
+    keep at most `limit` items of every group, items are assumed to be sorted by priority already
+
+    :param indexes:     (x, )
+    :param groups:      (x, ) group id of each item
+    :param limit:
+    :return:
+    """
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    starts = np.concatenate([[0], np.nonzero(np.diff(sorted_groups))[0] + 1])
+    group_starts = np.repeat(starts, np.diff(np.concatenate([starts, [len(groups)]])))
+    ranks = np.empty(len(groups), dtype=int)
+    ranks[order] = np.arange(len(groups)) - group_starts
+    return indexes[ranks < limit]
+
+
+def batched_nms(boxes, scores, groups, iou_threshold, max_boxes=None):
+    """
+    NMS over many classes (and images) in one call, boxes of different groups never suppress each other.
+    instead of looping over groups, every round keeps the best remaining box of every group at once
+    and drops the boxes overlapping it in the same group, so the count of rounds is the largest count
+    of boxes kept by one group (at most max_boxes), not the count of groups times kept boxes.
+
+    :param boxes:           (x, 4)
+    :param scores:          (x, )
+    :param groups:          (x, ) int, for example class id, or batch_index * num_classes + class id
+    :param iou_threshold:
+    :param max_boxes:       keep at most max_boxes of every group
+    :return:                indexes of kept boxes, sorted by score
+    """
+    if not len(boxes):
+        return np.zeros(0, dtype=int)
+
+    scores = np.asarray(scores)
+    groups = np.asarray(groups)
+    # 按组排列, 组内按分数从高到低, 每组剩余的第一个即为该组本轮保留的box
+    order = np.lexsort((-scores, groups))
+    boxes = np.asarray(boxes)[order]
+    groups = groups[order]
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    remaining = np.arange(len(boxes))
+    keep = []
+    while remaining.size:
+        remaining_groups = groups[remaining]
+        is_head = np.concatenate([[True], remaining_groups[1:] != remaining_groups[:-1]])
+        keep.append(remaining[is_head])
+        if max_boxes is not None and len(keep) >= max_boxes:
+            break
+
+        # 每个剩余box所在组的head
+        i = remaining[np.maximum.accumulate(np.where(is_head, np.arange(len(remaining)), 0))]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[remaining]) - np.maximum(x1[i], x1[remaining]) + 1)
+        h = np.maximum(0.0, np.minimum(y2[i], y2[remaining]) - np.maximum(y1[i], y1[remaining]) + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[remaining] - inter)
+        remaining = remaining[(ovr <= iou_threshold) & ~is_head]
+
+    keep = order[np.concatenate(keep)]
+    return keep[np.argsort(-scores[keep], kind='stable')]
+
+
 def rand(a=0, b=1):
     return np.random.rand() * (b - a) + a
 
@@ -118,6 +184,29 @@ def iou_cors_index(boxes, anchors):
     return iou
 
 
+def batch_iou_cors(boxes, true_boxes):
+    """
+    iou_cors_index of every image of a batch at once
+
+    :param boxes:           (N, ..., 4) --- (x, y, w, h)
+    :param true_boxes:      (N, M, 4) --- (x, y, w, h)
+    :return:                (N, ..., M)
+    """
+    # (N, ..., 1, 4)
+    boxes = K.expand_dims(boxes, -2)
+    # (N, 1, ..., 1, M, 4)
+    shape = tf.concat([tf.shape(true_boxes)[:1], tf.ones([tf.rank(boxes) - 3], tf.int32), tf.shape(true_boxes)[1:]], 0)
+    true_boxes = tf.reshape(true_boxes, shape)
+
+    # x and y are kept apart, so the broadcast (N, ..., M) tensors have no trailing axis to slice
+    x, y, w, h = tf.unstack(boxes, num=4, axis=-1)
+    true_x, true_y, true_w, true_h = tf.unstack(true_boxes, num=4, axis=-1)
+    intersect_w = K.maximum(K.minimum(x + w / 2., true_x + true_w / 2.) - K.maximum(x - w / 2., true_x - true_w / 2.), 0.)
+    intersect_h = K.maximum(K.minimum(y + h / 2., true_y + true_h / 2.) - K.maximum(y - h / 2., true_y - true_h / 2.), 0.)
+    intersect_area = intersect_w * intersect_h
+    return intersect_area / (w * h + true_w * true_h - intersect_area)
+
+
 # def tf_layer_name_compat(layer_v1_name):
 #     """
 #     layers' name are changed a lot from tf1 to tf2,
@@ -0,0 +1,230 @@
+"""
+数据集相关模块
+"""
+
+from collections import OrderedDict
+import cv2 as cv
+import numpy as np
+import copy
+import glob
+
+
+class AnnotationIndex:
+    """
+    labels file parsed once into contiguous arrays:
+        paths           (N, ) image paths
+        boxes           (M, 5) boxes of all images, one image after another
+        box_offsets     (N + 1, ) boxes of image i are boxes[box_offsets[i]: box_offsets[i + 1]]
+
+    index[i] returns (path, boxes), boxes is a small (K, 5) int array copy. Slicing returns an index
+    over the selected samples, so it can be used everywhere label lines are used:
+
+        index = AnnotationIndex.from_file(config.label_path)
+        train_lines, valid_lines = index[:-500], index[-500:]
+    """
+
+    def __init__(self, paths, boxes, box_offsets):
+        self.paths = np.asarray(paths)
+        self.boxes = np.asarray(boxes).reshape(-1, 5)
+        self.box_offsets = np.asarray(box_offsets, dtype=np.int64)
+        self.indexes = np.arange(len(self.paths))
+
+    @classmethod
+    def from_lines(cls, label_lines):
+        """
+        :param label_lines:     ['/Users/robbe/others/tf_data/voc2007/images/009095.jpg 1,305,231,500,10 1,249,181,330,17',
+                                 '/Users/robbe/others/tf_data/voc2007/images/009096.jpg 11,35,339,188,6', ...]
+        :return:
+        """
+        paths = []
+        box_counts = []
+        cors = []
+        for label_line in label_lines:
+            info = label_line.split()
+            if not info:
+                continue
+            paths.append(info[0])
+            box_counts.append(len(info) - 1)
+            cors.extend(info[1:])
+        # 所有box一次性转换
+        boxes = np.array(','.join(cors).split(',') if cors else [], dtype=np.int64)
+        box_offsets = np.concatenate([[0], np.cumsum(box_counts, dtype=np.int64)])
+        return cls(paths, boxes, box_offsets)
+
+    @classmethod
+    def from_file(cls, label_path: str):
+        with open(label_path) as f:
+            return cls.from_lines(f)
+
+    def load(self, index: int):
+        """
+        load one sample by its global index, ignoring the subset
+        :param index:
+        :return:        path, boxes (K, 5) int
+        """
+        boxes = np.array(self.boxes[self.box_offsets[index]: self.box_offsets[index + 1]], dtype=int)
+        return str(self.paths[index]), boxes
+
+    def subset(self, indexes):
+        """
+        an index sharing the same arrays but only over the given (local) indexes
+        """
+        subset = copy.copy(self)
+        subset.indexes = self.indexes[indexes]
+        return subset
+
+    def box_counts(self):
+        """
+        :return:        (n, ) count of boxes of every sample
+        """
+        return np.diff(self.box_offsets)[self.indexes]
+
+    def class_counts(self, num_classes: int):
+        """
+        :return:        (num_classes, ) count of boxes of every class
+        """
+        counts = self.box_counts()
+        # 每个样本的box行号: 样本起始行 + 样本内序号
+        rows = np.repeat(self.box_offsets[self.indexes], counts) + \
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.bincount(self.boxes[rows, 4], minlength=num_classes)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.subset(item)
+        return self.load(self.indexes[item])
+
+
+class ShardReader(AnnotationIndex):
+    """
+    memory-mapped reader of the shards written by pack.py
+
+    every shard is a pair of files:
+        xxx-00000.bin   raw uint8 pixels of all images, one after another
+        xxx-00000.npz   offsets and shapes of images, boxes with their offsets and source paths
+
+    reader[i] returns (image, boxes), image is a read-only view into the memory map (no copy, no decode),
+    boxes is a small (K, 5) int array copy. Slicing works the same as AnnotationIndex:
+
+        reader = ShardReader('/opt/voc2007/shards/voc')
+        train_lines, valid_lines = reader[:-500], reader[-500:]
+    """
+
+    def __init__(self, shard_prefix: str):
+        self.shard_prefix = shard_prefix
+        self.index_files = sorted(glob.glob(shard_prefix + '-*.npz'))
+        assert self.index_files, 'no shard found with prefix {}, run pack.py first'.format(shard_prefix)
+
+        shard_ids, image_offsets, image_shapes, box_offsets, boxes, paths = [], [], [], [], [], []
+        box_start = 0
+        for shard_id, index_file in enumerate(self.index_files):
+            index = np.load(index_file)
+            n = len(index['image_shapes'])
+            shard_ids.append(np.full(n, shard_id, dtype=np.int32))
+            image_offsets.append(index['image_offsets'][:-1])
+            image_shapes.append(index['image_shapes'])
+            box_offsets.append(index['box_offsets'][:-1] + box_start)
+            boxes.append(index['boxes'])
+            paths.append(index['paths'])
+            box_start += len(index['boxes'])
+
+        super(ShardReader, self).__init__(np.concatenate(paths),
+                                          np.concatenate(boxes),
+                                          np.append(np.concatenate(box_offsets), box_start))
+        self.shard_ids = np.concatenate(shard_ids)
+        self.image_offsets = np.concatenate(image_offsets)
+        self.image_shapes = np.concatenate(image_shapes)
+        self._data = None
+
+    def _open(self):
+        self._data = [np.memmap(index_file[:-len('.npz')] + '.bin', dtype=np.uint8, mode='r')
+                      for index_file in self.index_files]
+
+    def load(self, index: int):
+        """
+        load one sample by its global index, ignoring the subset
+        :param index:
+        :return:        image (h, w, 3) uint8, boxes (K, 5) int
+        """
+        if self._data is None:
+            self._open()
+        h, w, c = self.image_shapes[index]
+        start = self.image_offsets[index]
+        image = self._data[self.shard_ids[index]][start: start + h * w * c].reshape(h, w, c)
+        boxes = np.array(self.boxes[self.box_offsets[index]: self.box_offsets[index + 1]], dtype=int)
+        return image, boxes
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in every process
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
+class ImageCache:
+    """
+    byte-budgeted LRU cache of decoded images keyed by path.
+
+    mixup and mosaic pull several random images per sample, so the same files are decoded again and again
+    within an epoch. cached images are marked read-only because they are shared by every caller,
+    copy before writing into them.
+
+    the cache lives in each process, with parallel_data_generator every worker keeps its own one.
+    to share decoded pixels across workers use ShardReader, its memory maps share the OS page cache.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        """
+        :param max_bytes:       memory budget, 0 disables caching
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+
+    def read(self, path: str):
+        """
+        same as cv.imread(path), but served from the cache when possible
+        """
+        img = self._images.get(path)
+        if img is not None:
+            self._images.move_to_end(path)
+            self.hits += 1
+            return img
+
+        self.misses += 1
+        img = cv.imread(path)
+        if img is None or img.nbytes > self.max_bytes:
+            return img
+        img.flags.writeable = False
+        self._images[path] = img
+        self.bytes += img.nbytes
+        while self.bytes > self.max_bytes:
+            _, old_img = self._images.popitem(last=False)
+            self.bytes -= old_img.nbytes
+        return img
+
+    def clear(self):
+        self._images.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """
+        :return:    dict of hits, misses, hit_rate, count and bytes
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.,
+                'count': len(self._images),
+                'bytes': self.bytes}
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, path):
+        return path in self._images
@@ -2,29 +2,55 @@ from PIL import Image, ImageDraw, ImageFont
 from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
 import cv2 as cv
 import config
+from tools import utils_data
 import colorsys
 import numpy as np
-import random
 import copy
 
 
+# 解码图片的LRU缓存, 大小由config.cache_bytes控制
+image_cache = utils_data.ImageCache(config.cache_bytes)
+
+
 def resize_image(image, new_size):
-    iw, ih = image.shape[1], image.shape[0]
     w, h = new_size
-    scale = min(w / iw, h / ih)
-    nw = int(iw * scale)
-    nh = int(ih * scale)
-
-    image = cv.resize(image, (nw, nh), cv.INTER_CUBIC)
+    new_image = np.empty((h, w, 3), dtype=image.dtype)
+    letterbox(image, new_image)
+    return new_image
 
-    new_image = np.full((h, w, 3), 128)
-    h1 = (h - nh) // 2
-    h2 = (h + nh) // 2
-    w1 = (w - nw) // 2
-    w2 = (w + nw) // 2
 
-    new_image[h1:h2, w1:w2, :] = image
-    return new_image
+def letterbox(image, out, fill=128, interpolation=cv.INTER_LINEAR):
+    """
+    resize an image keeping its aspect ratio straight into the center of out, the border is filled with fill.
+    out is usually one slot of a preallocated batch, so nothing full-size is allocated when dtypes match
+
+    example:
+            image_data = np.empty((len(images), 608, 608, 3), dtype='uint8')
+            scales, offsets = zip(*[letterbox(image, image_data[i]) for i, image in enumerate(images)])
+
+    :param image:           (ih, iw, 3)
+    :param out:             (h, w, 3) uint8 or float32 buffer
+    :param fill:
+    :param interpolation:
+    :return:                scale (2, ) and offset (2, ) in (y, x) order, pixel of out = pixel of image * scale + offset.
+                            pass them to eval.yolo_decode to map boxes back
+    """
+    ih, iw = image.shape[:2]
+    h, w = out.shape[:2]
+    ratio = min(w / iw, h / ih)
+    nw, nh = int(iw * ratio), int(ih * ratio)
+    dy, dx = (h - nh) // 2, (w - nw) // 2
+
+    out[:dy] = fill
+    out[dy + nh:] = fill
+    out[dy: dy + nh, :dx] = fill
+    out[dy: dy + nh, dx + nw:] = fill
+    dst = out[dy: dy + nh, dx: dx + nw]
+    if dst.dtype == image.dtype:
+        cv.resize(image, (nw, nh), dst=dst, interpolation=interpolation)
+    else:
+        dst[...] = cv.resize(image, (nw, nh), interpolation=interpolation)
+    return np.array([nh / ih, nw / iw]), np.array([dy, dx], dtype=np.float64)
 
 
 def get_random_colors(nums):
@@ -102,10 +128,28 @@ class Augment:
                  boxes: list or np.ndarray = None,
                  img_path: str = None,
                  img_info_list: list = None,
+                 policy: dict = None,
+                 rng: np.random.RandomState = None,
                  **kwargs):
+        """
+
+        :param img:
+        :param boxes:
+        :param img_path:
+        :param img_info_list:   where mixup and mosaic draw their extra images from
+        :param policy:          {op: {'p': probability, **params}}, ops run in order, default is config.augment_policy
+        :param rng:             random state of this sample, every random draw of augment comes from it so a sample
+                                can be replayed in any process, default is np.random
+        :param kwargs:          new_shape, seed (builds rng when rng is not given),
+                                normalize (default True, False returns the raw uint8 image)
+        """
+        if rng is None:
+            rng = np.random.RandomState(kwargs['seed']) if kwargs.get('seed') is not None else np.random
+        self.rng = rng
+        self.policy = policy or config.augment_policy
         self.img_info_list = img_info_list or kwargs.get('img_info_list')
-        if self.img_info_list:
-            self.img, self.boxes = self.load_file_from_list(self.img_info_list, 1)
+        if self.img_info_list and img is None and not img_path:
+            self.img, self.boxes = self.load_file_from_list(self.img_info_list, 1, rng=self.rng)
             self.img_path = None
         else:
             self.img = img
@@ -127,56 +171,96 @@ class Augment:
 
     def augment(self):
         """
-        you'd better do not change the order of augment - -
+        run the ops of self.policy in order, each one with its own probability.
+
+        rotate, flip and resize are not applied one by one, their matrices are composed and the image
+        is warped only once (before mixup and colors, which need the current image, or at the end).
+        pixel works on the raw image and boxes, mosaic replaces the image, so a pending warp is dropped there.
         :return:
         """
 
         if self.img_path:
-            self.img = cv.imread(self.img_path)
-        if self.check_random(3):
-            self.img, self.boxes = self.rotate(self.img, self.boxes, angel=self.set_random(3) * 90)
-        if self.check_random(3):
-            self.img, self.boxes = self.flip(self.img, self.boxes, flip_code=self.set_random(2) - 1)
-        if self.check_random(2):
-            self.img, self.boxes = self.pixel(self.img, self.boxes)
-        if self.check_random(4):
-            self.img, self.boxes = self.mixup(self.img, self.boxes, img_info_list=self.img_info_list)
-        if self.check_random(3):
-            self.img, self.boxes = self.mosaic(imgs=self.img, img_info_list=self.img_info_list)
-
-        if self.check_random(1):
-            self.img, self.boxes = self.resize(self.img, self.boxes,
-                                               new_shape=self.kwargs.get('new_shape') or (608, 608))
-
-        if self.check_random(3, 2):
-            self.img, self.boxes = self.colors(self.img, self.boxes)
+            self.img = image_cache.read(self.img_path)
+        h, w = self.img.shape[:2]
+        self.matrix, self.dsize, self.border_value = np.eye(3), (w, h), 0
+        for op, params in self.policy.items():
+            params = dict(params)
+            if self.rng.rand() < params.pop('p', 1.):
+                getattr(self, '_apply_' + op)(**params)
+        self._flush()
+        if not self.kwargs.get('normalize', True):
+            return self.img, self.boxes
         return self.img / 255.0, self.boxes
 
+    def _flush(self):
+        """
+        apply the pending matrix
+        """
+        self.img, self.boxes = self.warp(self.img, self.boxes, self.matrix, self.dsize,
+                                         border_value=self.border_value, interpolation=cv.INTER_CUBIC)
+        self.matrix, self.dsize, self.border_value = np.eye(3), (self.img.shape[1], self.img.shape[0]), 0
+
+    def _apply_rotate(self, angels=(0, 90, 180, 270)):
+        w, h = self.dsize
+        self.matrix = self.rotate_matrix(h, w, angel=angels[self.rng.randint(len(angels))]) @ self.matrix
+
+    def _apply_flip(self, flip_codes=(-1, 0, 1)):
+        w, h = self.dsize
+        self.matrix = self.flip_matrix(h, w, flip_code=flip_codes[self.rng.randint(len(flip_codes))]) @ self.matrix
+
+    def _apply_pixel(self, **params):
+        # pixel only touches pixels inside boxes, so it can run before the pending warp
+        self.img, self.boxes = self.pixel(self.img, self.boxes, rng=self.rng, **params)
+
+    def _apply_mixup(self):
+        self._flush()
+        self.img, self.boxes = self.mixup(self.img, self.boxes, img_info_list=self.img_info_list, rng=self.rng)
+
+    def _apply_mosaic(self):
+        self.img, self.boxes = self.mosaic(imgs=[self.img], boxes=[self.boxes],
+                                           img_info_list=self.img_info_list, rng=self.rng)
+        self.matrix, self.dsize, self.border_value = np.eye(3), (self.img.shape[1], self.img.shape[0]), 0
+
+    def _apply_resize(self, scale=(0.5, 1.5)):
+        w, h = self.dsize
+        new_shape = self.kwargs.get('new_shape') or (608, 608)
+        self.matrix = self.resize_matrix(h, w, new_shape, scale=scale, rng=self.rng) @ self.matrix
+        self.dsize = (new_shape[1], new_shape[0])
+        self.border_value = self.rng.randint(0, 256, size=3).tolist()
+
+    def _apply_colors(self, **params):
+        self._flush()
+        self.img, self.boxes = self.colors(self.img, self.boxes, rng=self.rng, **params)
+
     @staticmethod
-    def check_random(num: int, target_num=1):
+    def check_random(num: int, target_num=1, rng=None):
         """
-        return True with a ratio of num * 10%
+        return True with a ratio of target_num / num
         :param num:
         :return:
         """
-        if random.randint(1, num) <= target_num:
+        rng = rng or np.random
+        if rng.randint(1, num + 1) <= target_num:
             return True
         return
 
     @staticmethod
     def set_random(end: int,
-                   start: int = 0):
+                   start: int = 0,
+                   rng=None):
         """
         get random integer number between start and end
         :param end:
         :param start:
         :return:
         """
-        return random.randint(start, end)
+        rng = rng or np.random
+        return rng.randint(start, end + 1)
 
     @staticmethod
     def scope_random(start: int or float = 0.0,
-                     end: int or float = 1.0):
+                     end: int or float = 1.0,
+                     rng=None):
         """
         get random number between start and end
 
@@ -184,14 +268,16 @@ class Augment:
         :param end:
         :return:
         """
-        return np.random.rand() * (end - start) + start
+        rng = rng or np.random
+        return rng.rand() * (end - start) + start
 
     @staticmethod
     def load_file_from_list(img_info_list: list,
-                            cnt: int = 2):
+                            cnt: int = 2,
+                            rng=None):
         """
         load file from lines
-        :param img_info_list:
+        :param img_info_list:       label lines, or a tools.utils_data.AnnotationIndex / ShardReader
         :param cnt:
         :return:
 
@@ -202,15 +288,22 @@ class Augment:
             imgs, boxes = load_file_from_list(lines, 2)
 
         """
-        label_lines = np.random.choice(img_info_list, cnt)
+        rng = rng or np.random
+        indexes = rng.randint(0, len(img_info_list), cnt)
 
         img_list = []
         box_list = []
-        for label_line in label_lines:
-            info = label_line.split()
-            image_file_path, cors = info[0], info[1:]
-            img = cv.imread(image_file_path)
-            cors = np.array([np.array(list(map(int, box.split(',')))) for box in cors], dtype=int)
+        for index in indexes:
+            label_line = img_info_list[index]
+            if isinstance(label_line, str):
+                info = label_line.split()
+                image_file_path, cors = info[0], info[1:]
+                img = image_cache.read(image_file_path)
+                cors = np.array([np.array(list(map(int, box.split(',')))) for box in cors], dtype=int)
+            else:
+                img, cors = label_line
+                if isinstance(img, str):
+                    img = image_cache.read(img)
             img_list.append(img)
             box_list.append(cors)
         if cnt == 1:
@@ -221,7 +314,7 @@ class Augment:
     def correct_boxes(height, width, boxes, aug_type='rotate', **kwargs):
         """
 
-        for correcting raw boxes to new boxes after augment
+        for correcting raw boxes to new boxes after augment, all boxes are corrected at once
 
         :param height:      image height
         :param width:       image width
@@ -230,121 +323,171 @@ class Augment:
         :param kwargs:      params with different type of augment
         :return:
         """
-        result = []
-        boxes = np.asarray(boxes)
+        boxes = np.asarray(boxes).reshape(-1, 5)
+        x1, y1, x2, y2, class_id = boxes.T
 
         w0 = (width - 0.5) / 2.0
         h0 = (height - 0.5) / 2.0
-        for box in boxes:
-            x1, y1, x2, y2, class_id = box
-            rela_x0 = (x1 + x2) / float(width) / 2
-            rela_y0 = (y1 + y2) / float(height) / 2
-            rela_w0 = np.abs(x1 - x2) / float(width)
-            rela_h0 = np.abs(y1 - y2) / float(height)
-
-            if aug_type == 'rotate':
-                '''
-                as normal, formula for Coordinate point rotation is :
-                        x_new = (x - w0) * np.cos(angel) - (y - h0) * np.sin(angel) + w0
-                        y_new = (x - w0) * np.sin(angel) + (y - h0) * np.cos(angel) + h0
-                but in our case, the first quadrant should be changed into the forth quadrant in morphology fields.
-                '''
-
-                angel = kwargs.get('angel', 0)
-                angel = angel * 2 * np.pi / 360
-
-                fxy = lambda x, y: [(x - w0) * np.cos(angel) - (-y - -h0) * np.sin(angel) + w0,
-                                    -((x - w0) * np.sin(angel) + (-y - -h0) * np.cos(angel) + -h0)]
-
-                x11, y11 = fxy(x1, y1)
-                x22, y22 = fxy(x2, y2)
-                x33, y33 = fxy(x2, y1)
-                x44, y44 = fxy(x1, y2)
-
-                new_x1 = np.round(np.min([x11, x22, x33, x44])).astype(int)
-                new_x2 = np.round(np.max([x11, x22, x33, x44])).astype(int)
-                new_y1 = np.round(np.min([y11, y22, y33, y44])).astype(int)
-                new_y2 = np.round(np.max([y11, y22, y33, y44])).astype(int)
-
-                new_x1 = np.max([0, new_x1])
-                new_x2 = np.min([width, new_x2])
-                new_y1 = np.max([0, new_y1])
-                new_y2 = np.min([height, new_y2])
-
-                result.append([new_x1, new_y1, new_x2, new_y2, class_id])
-
-            elif aug_type == 'flip':
-                if kwargs.get('flip_code', 1) == 1:
-                    new_x1 = width - x2
-                    new_x2 = width - x1
-                    new_y1 = y1
-                    new_y2 = y2
-                elif kwargs.get('flip_code', 0) == 0:
-                    new_y1 = height - y2
-                    new_y2 = height - y1
-                    new_x1 = x1
-                    new_x2 = x2
-                elif kwargs.get('flip_code', -1) == -1:
-                    new_x1 = width - x2
-                    new_x2 = width - x1
-                    new_y1 = height - y2
-                    new_y2 = height - y1
-                result.append([new_x1, new_y1, new_x2, new_y2, class_id])
-
-            elif aug_type == 'resize':
-                new_h, new_w = kwargs.get('new_h'), kwargs.get('new_w')
-                bg_h, bg_w = kwargs.get('bg_h'), kwargs.get('bg_w')
-
-                dh = (bg_h - new_h) / 2.0
-                dw = (bg_w - new_w) / 2.0
-
-                abs_new_x0 = new_w * rela_x0
-                abs_new_y0 = new_h * rela_y0
-                abs_new_w0 = new_w * rela_w0
-                abs_new_h0 = new_h * rela_h0
-
-                if dh >= 0 and dw >= 0:
-                    new_x1 = abs_new_x0 - abs_new_w0 / 2.0 + dw
-                    new_x2 = abs_new_x0 + abs_new_w0 / 2.0 + dw
-                    new_y1 = abs_new_y0 - abs_new_h0 / 2.0 + dh
-                    new_y2 = abs_new_y0 + abs_new_h0 / 2.0 + dh
-                    new_x1 = np.max([dw, new_x1])
-                    new_x2 = np.min([dw + new_w, new_x2])
-                    new_y1 = np.max([dh, new_y1])
-                    new_y2 = np.min([dh + new_h, new_y2])
-
-                elif dh < 0 and dw >= 0:
-                    new_x1 = abs_new_x0 - abs_new_w0 / 2.0 + dw
-                    new_x2 = abs_new_x0 + abs_new_w0 / 2.0 + dw
-                    new_y1 = abs_new_y0 + dh - abs_new_h0 / 2.0
-                    new_y2 = new_y1 + abs_new_h0
-                    new_y1 = np.max([dh, new_y1])
-                    new_y2 = np.min([dh + new_h, new_y2])
-
-                elif dh >= 0 and dw < 0:
-                    new_x1 = abs_new_x0 + dw - abs_new_w0 / 2.0
-                    new_x2 = new_x1 + abs_new_w0
-                    new_y1 = abs_new_y0 - abs_new_h0 / 2.0 + dh
-                    new_y2 = abs_new_y0 + abs_new_h0 / 2.0 + dh
-                    new_x1 = np.max([dw, new_x1])
-                    new_x2 = np.min([dw + new_w, new_x2])
-
-                else:
-                    new_x1 = abs_new_x0 + dw - abs_new_w0 / 2.0
-                    new_x2 = new_x1 + abs_new_w0
-                    new_y1 = abs_new_y0 + dh - abs_new_h0 / 2.0
-                    new_y2 = new_y1 + abs_new_h0
-
-                new_x1 = np.max([0, new_x1])
-                new_x2 = np.min([new_x2, bg_w - 1])
-                new_y1 = np.max([0, new_y1])
-                new_y2 = np.min([new_y2, bg_h - 1])
-                if new_x1 >= bg_w or new_y1 >= bg_h:
-                    continue
-                result.append([new_x1, new_y1, new_x2, new_y2, class_id])
+        rela_x0 = (x1 + x2) / float(width) / 2
+        rela_y0 = (y1 + y2) / float(height) / 2
+        rela_w0 = np.abs(x1 - x2) / float(width)
+        rela_h0 = np.abs(y1 - y2) / float(height)
+
+        if aug_type == 'rotate':
+            '''
+            as normal, formula for Coordinate point rotation is :
+                    x_new = (x - w0) * np.cos(angel) - (y - h0) * np.sin(angel) + w0
+                    y_new = (x - w0) * np.sin(angel) + (y - h0) * np.cos(angel) + h0
+            but in our case, the first quadrant should be changed into the forth quadrant in morphology fields.
+            '''
+
+            angel = kwargs.get('angel', 0)
+            angel = angel * 2 * np.pi / 360
+
+            # (4, K), corners (x1, y1), (x2, y2), (x2, y1), (x1, y2)
+            xs = np.stack([x1, x2, x2, x1])
+            ys = np.stack([y1, y2, y1, y2])
+            new_xs = (xs - w0) * np.cos(angel) - (-ys - -h0) * np.sin(angel) + w0
+            new_ys = -((xs - w0) * np.sin(angel) + (-ys - -h0) * np.cos(angel) + -h0)
+
+            new_x1 = np.maximum(0, np.round(new_xs.min(axis=0)).astype(int))
+            new_x2 = np.minimum(width, np.round(new_xs.max(axis=0)).astype(int))
+            new_y1 = np.maximum(0, np.round(new_ys.min(axis=0)).astype(int))
+            new_y2 = np.minimum(height, np.round(new_ys.max(axis=0)).astype(int))
+            keep = np.ones(len(boxes), dtype=bool)
+
+        elif aug_type == 'flip':
+            flip_code = kwargs.get('flip_code', 1)
+            new_x1, new_x2, new_y1, new_y2 = x1, x2, y1, y2
+            if flip_code in (1, -1):
+                new_x1, new_x2 = width - x2, width - x1
+            if flip_code in (0, -1):
+                new_y1, new_y2 = height - y2, height - y1
+            keep = np.ones(len(boxes), dtype=bool)
+
+        elif aug_type == 'resize':
+            new_h, new_w = kwargs.get('new_h'), kwargs.get('new_w')
+            bg_h, bg_w = kwargs.get('bg_h'), kwargs.get('bg_w')
+
+            dh = (bg_h - new_h) / 2.0
+            dw = (bg_w - new_w) / 2.0
+
+            abs_new_x0 = new_w * rela_x0
+            abs_new_y0 = new_h * rela_y0
+            abs_new_w0 = new_w * rela_w0
+            abs_new_h0 = new_h * rela_h0
+
+            # 横向与纵向分别处理, 图片比背景小时box限制在图片范围内
+            if dw >= 0:
+                new_x1 = np.maximum(dw, abs_new_x0 - abs_new_w0 / 2.0 + dw)
+                new_x2 = np.minimum(dw + new_w, abs_new_x0 + abs_new_w0 / 2.0 + dw)
+            else:
+                new_x1 = abs_new_x0 + dw - abs_new_w0 / 2.0
+                new_x2 = new_x1 + abs_new_w0
+            if dh >= 0:
+                new_y1 = np.maximum(dh, abs_new_y0 - abs_new_h0 / 2.0 + dh)
+                new_y2 = np.minimum(dh + new_h, abs_new_y0 + abs_new_h0 / 2.0 + dh)
+            else:
+                new_y1 = abs_new_y0 + dh - abs_new_h0 / 2.0
+                new_y2 = new_y1 + abs_new_h0
+
+            new_x1 = np.maximum(0, new_x1)
+            new_x2 = np.minimum(new_x2, bg_w - 1)
+            new_y1 = np.maximum(0, new_y1)
+            new_y2 = np.minimum(new_y2, bg_h - 1)
+            keep = (new_x1 < bg_w) & (new_y1 < bg_h)
 
+        else:
+            return np.zeros((0, 5), dtype=int)
+
+        result = np.stack([new_x1, new_y1, new_x2, new_y2, class_id], axis=-1)[keep]
         return np.asarray(result, dtype=int)
 
+    @staticmethod
+    def rotate_matrix(height, width, angel=0):
+        """
+        3x3 matrix of Augment.rotate, all matrices work on continuous coordinates where pixel i covers [i, i + 1)
+        """
+        matrix = cv.getRotationMatrix2D((width / 2.0, height / 2.0), angel, 1)
+        return np.vstack([matrix, [0, 0, 1]])
+
+    @staticmethod
+    def flip_matrix(height, width, flip_code=1):
+        """
+        3x3 matrix of Augment.flip
+        """
+        matrix = np.eye(3)
+        if flip_code != 0:
+            matrix[0] = [-1, 0, width]
+        if flip_code != 1:
+            matrix[1] = [0, -1, height]
+        return matrix
+
+    @staticmethod
+    def resize_matrix(height, width, new_shape=(608, 608), scale=(0.5, 1.5), rng=None):
+        """
+        3x3 matrix of Augment.resize, with the same random scale and the same placement on the background
+        """
+        rng = rng or np.random
+        bg_h, bg_w = new_shape
+        low, high = int(round(scale[0] * 100)), int(round(scale[1] * 100))
+        ratio_x, ratio_y = rng.randint(low, high) / 100.0, rng.randint(low, high) / 100.0
+        new_h = min(int(np.ceil(height * ratio_y)), bg_h)
+        new_w = min(int(np.ceil(width * ratio_x)), bg_w)
+        return np.array([[new_w / width, 0, -((new_w - bg_w) // 2)],
+                         [0, new_h / height, -((new_h - bg_h) // 2)],
+                         [0, 0, 1]])
+
+    @staticmethod
+    def transform_boxes(boxes, matrix, width, height):
+        """
+        move all boxes with a 3x3 matrix at once, boxes are clipped into (width, height) and empty ones are dropped
+
+        :param boxes:       (K, 5)
+        :param matrix:      3x3
+        :param width:       width of the new image
+        :param height:      height of the new image
+        :return:
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+        x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        # (K, 4, 2)
+        corners = np.stack([np.stack([x1, y1], -1), np.stack([x2, y1], -1),
+                            np.stack([x1, y2], -1), np.stack([x2, y2], -1)], axis=1)
+        corners = corners @ matrix[:2, :2].T + matrix[:2, 2]
+        limit = [width - 1, height - 1]
+        mins = np.clip(np.round(corners.min(axis=1)), 0, limit)
+        maxes = np.clip(np.round(corners.max(axis=1)), 0, limit)
+        keep = np.all(maxes > mins, axis=-1)
+        return np.concatenate([mins, maxes, boxes[:, 4:5]], axis=-1)[keep].astype(int)
+
+    @staticmethod
+    def warp(img: np.ndarray,
+             boxes: list or np.ndarray,
+             matrix: np.ndarray,
+             dsize,
+             border_value=0,
+             interpolation=cv.INTER_LINEAR):
+        """
+        apply a 3x3 matrix (for example rotate_matrix @ flip_matrix @ resize_matrix) to image and boxes in one pass
+
+        :param img:
+        :param boxes:
+        :param matrix:          3x3, continuous coordinates
+        :param dsize:           (w, h) of the new image
+        :param border_value:    color outside of the raw image
+        :param interpolation:
+        :return:
+        """
+        if np.allclose(matrix, np.eye(3)) and dsize == (img.shape[1], img.shape[0]):
+            return img, boxes
+        # continuous coordinates -> pixel index coordinates used by warpAffine
+        state = matrix[:2].copy()
+        state[:, 2] += state[:, :2] @ [0.5, 0.5] - 0.5
+        new_img = cv.warpAffine(img, state, dsize, flags=interpolation,
+                                borderMode=cv.BORDER_CONSTANT, borderValue=border_value)
+        return new_img, Augment.transform_boxes(boxes, matrix, *dsize)
+
     @staticmethod
     def rotate(img: np.ndarray,
                boxes: list or np.ndarray = None,
@@ -410,7 +553,8 @@ class Augment:
               boxes: list or np.ndarray = None,
               pixel_num=10,
               mask_ratio=0.3,
-              kernel_ratio=0.1):
+              kernel_ratio=0.1,
+              rng=None):
         """
 
         :param img:
@@ -436,12 +580,16 @@ class Augment:
                 cv.destroyAllWindows()
         """
 
+        rng = rng or np.random
+        # images from ShardReader or image_cache are read-only
+        if not img.flags.writeable:
+            img = img.copy()
         if not len(boxes):
-            for block in range(np.random.randint(1, pixel_num)):
+            for block in range(rng.randint(1, pixel_num)):
                 h, w = img.shape[:2]
 
-                start_ratio_x = np.random.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
-                start_ratio_y = np.random.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
+                start_ratio_x = rng.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
+                start_ratio_y = rng.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
                 end_ratio_x = start_ratio_x + mask_ratio
                 end_ratio_y = start_ratio_y + mask_ratio
 
@@ -454,13 +602,10 @@ class Augment:
 
                 base_len = min(h, w)
                 kernel_size = max(np.round(base_len * kernel_ratio).astype(int), 2)
-                for i in range(0, h - kernel_size, kernel_size):
-                    for j in range(0, w - kernel_size, kernel_size):
-                        color = img[i + kernel_size][j].tolist()
-                        sub_img = cv.rectangle(sub_img, (j, i), (j + kernel_size - 1, i + kernel_size - 1),
-                                               color, -1)
-                sub_img = cv.rectangle(sub_img, (0, 0), (w - 1, h - 1), (0, 250, 0))
-                img[starty: endy, startx: endx, :] = sub_img
+                # cells are laid on the whole image and cut by the field, colors come from the whole image
+                Augment.pixel_cells(img, kernel_size, out=sub_img)
+                sub_img[0, :] = (0, 250, 0)
+                sub_img[:, 0] = (0, 250, 0)
             return img, []
 
         for box in boxes:
@@ -468,9 +613,9 @@ class Augment:
             box_image = img[y1:y2, x1:x2, :]
             h_, w_ = box_image.shape[:2]
 
-            for block in range(np.random.randint(1, pixel_num)):
-                start_ratio_x = np.random.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
-                start_ratio_y = np.random.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
+            for block in range(rng.randint(1, pixel_num)):
+                start_ratio_x = rng.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
+                start_ratio_y = rng.randint(1, 1000 * (1 - mask_ratio)) / 1000.0
                 end_ratio_x = start_ratio_x + mask_ratio
                 end_ratio_y = start_ratio_y + mask_ratio
 
@@ -484,16 +629,32 @@ class Augment:
                 h__, w__ = sub_box_image.shape[:2]
                 base_len = min(h__, w__)
                 kernel_size = max(np.round(base_len * kernel_ratio).astype(int), 2)
-
-                for i in range(0, h__ - kernel_size, kernel_size):
-                    for j in range(0, w__ - kernel_size, kernel_size):
-                        color = sub_box_image[i + kernel_size][j].tolist()
-                        sub_box_image = cv.rectangle(sub_box_image, (j, i), (j + kernel_size - 1, i + kernel_size - 1),
-                                                     color, -1)
-                box_image[starty: endy, startx: endx, :] = sub_box_image
-            img[y1:y2, x1:x2, :] = box_image
+                Augment.pixel_cells(sub_box_image, kernel_size, out=sub_box_image)
         return img, np.asarray(boxes, dtype=int)
 
+    @staticmethod
+    def pixel_cells(img: np.ndarray, kernel_size: int, out: np.ndarray = None):
+        """
+        pixelate an image with square cells of kernel_size, all cells at once.
+        each cell takes the color of the pixel just below its top-left corner, cells are only laid
+        while a whole cell and that pixel fit in img, the rest keeps its raw pixels
+        :param img:
+        :param kernel_size:
+        :param out:             image to paint cells into (may be img itself), cells are cut by its shape,
+                                default is a copy of img
+        :return:                out
+        """
+        if out is None:
+            out = img.copy()
+        h, w = img.shape[:2]
+        rows = min(len(range(0, h - kernel_size, kernel_size)), -(-out.shape[0] // kernel_size))
+        cols = min(len(range(0, w - kernel_size, kernel_size)), -(-out.shape[1] // kernel_size))
+        if rows > 0 and cols > 0:
+            colors = img[kernel_size: (rows + 1) * kernel_size: kernel_size, 0: cols * kernel_size: kernel_size]
+            cells = np.repeat(np.repeat(colors, kernel_size, axis=0), kernel_size, axis=1)
+            out[:rows * kernel_size, :cols * kernel_size] = cells[:out.shape[0], :out.shape[1]]
+        return out
+
     @staticmethod
     def noise(img, boxes, noisy_type=0):
 
@@ -533,13 +694,14 @@ class Augment:
             cv.destroyAllWindows()
         """
 
+        rng = kwargs.get('rng')
         img_info_list = img_info_list or kwargs.get('img_info_list')
         if img_info_list and not len(img1):
-            imgs, boxes = Augment.load_file_from_list(img_info_list, 2)
+            imgs, boxes = Augment.load_file_from_list(img_info_list, 2, rng=rng)
             img1, img2 = imgs
             boxes1, boxes2 = boxes
         elif img_info_list and len(img1) and len(boxes1):
-            img2, boxes2 = Augment.load_file_from_list(img_info_list, 1)
+            img2, boxes2 = Augment.load_file_from_list(img_info_list, 1, rng=rng)
         elif len(img1) and len(boxes1) and not len(img2):
             img2 = copy.deepcopy(img1)
             boxes2 = copy.deepcopy(boxes1)
@@ -573,7 +735,8 @@ class Augment:
     @staticmethod
     def resize(img: np.ndarray,
                boxes: list or np.ndarray = None,
-               new_shape=(608, 608)
+               new_shape=(608, 608),
+               rng=None
                ):
         """
 
@@ -596,13 +759,14 @@ class Augment:
                 cv.destroyAllWindows()
         """
 
+        rng = rng or np.random
         h, w = img.shape[:2]
         bg_h, bg_w = new_shape
-        ratio_x, ratio_y = np.random.randint(50, 150) / 100.0, np.random.randint(50, 150) / 100.0
+        ratio_x, ratio_y = rng.randint(50, 150) / 100.0, rng.randint(50, 150) / 100.0
         new_h, new_w = np.min([np.ceil(h * ratio_y).astype(int), bg_h]), np.min(
             [np.ceil(w * ratio_x).astype(int), bg_w])
         new_image = cv.resize(img, (new_w, new_h), interpolation=cv.INTER_CUBIC)
-        bg_image = np.ones(shape=(bg_h, bg_w, 3), dtype=new_image.dtype) * np.random.random_integers(0, 255, size=(
+        bg_image = np.ones(shape=(bg_h, bg_w, 3), dtype=new_image.dtype) * rng.randint(0, 256, size=(
             1, 1, 3)).astype(new_image.dtype)
         # dh = int(round((new_h - bg_h + 0.5) // 2.0 - 1))
         # dw = int(round((new_w - bg_w + 0.5) // 2.0 - 1))
@@ -635,7 +799,9 @@ class Augment:
 
         :param img:
         :param boxes:
-        :param kwargs:          mainly includes hue, sat and val
+        :param kwargs:          mainly includes hue, sat, val and mode,
+                                mode 'lut' jitters uint8 images in opencv hsv space with lookup tables,
+                                mode 'float' uses float hsv of matplotlib, default is config.color_mode
         :return:
 
         example:
@@ -652,23 +818,40 @@ class Augment:
                 cv.destroyAllWindows()
         """
         hue = kwargs.get('hue', 0.1)
-        sat = kwargs.get('hue', 1.5)
-        val = kwargs.get('hue', 1.5)
-        hue = Augment.scope_random(-hue, hue)
-        sat = Augment.scope_random(1, sat) if Augment.scope_random() < .5 else 1 / Augment.scope_random(1, sat)
-        val = Augment.scope_random(1, val) if Augment.scope_random() < .5 else 1 / Augment.scope_random(1, val)
-        x = rgb_to_hsv(np.array(img) / 255.)
-        x[..., 0] += hue
-        x[..., 0][x[..., 0] > 1] -= 1
-        x[..., 0][x[..., 0] < 0] += 1
-        x[..., 1] *= sat
-        x[..., 2] *= val
-        x[x > 1] = 1
-        x[x < 0] = 0
-        new_image = hsv_to_rgb(x)
-        if kwargs.get('return_back') or return_back:
-            new_image *= 255
-            new_image = np.asarray(new_image, np.uint8)
+        sat = kwargs.get('sat', 1.5)
+        val = kwargs.get('val', 1.5)
+        rng = kwargs.get('rng')
+        hue = Augment.scope_random(-hue, hue, rng=rng)
+        sat = Augment.scope_random(1, sat, rng=rng) if Augment.scope_random(rng=rng) < .5 \
+            else 1 / Augment.scope_random(1, sat, rng=rng)
+        val = Augment.scope_random(1, val, rng=rng) if Augment.scope_random(rng=rng) < .5 \
+            else 1 / Augment.scope_random(1, val, rng=rng)
+
+        img = np.asarray(img)
+        if kwargs.get('mode', config.color_mode) == 'lut' and img.dtype == np.uint8:
+            # opencv uint8 hsv: h in [0, 180), s and v in [0, 255], one lookup table per channel
+            table = np.arange(256, dtype=np.float32)
+            lut = np.stack([np.mod(table + hue * 180, 180),
+                            np.clip(table * sat, 0, 255),
+                            np.clip(table * val, 0, 255)], axis=-1)
+            lut = np.round(lut).astype(np.uint8).reshape(256, 1, 3)
+            x = cv.cvtColor(img, cv.COLOR_BGR2HSV)
+            new_image = cv.cvtColor(cv.LUT(x, lut), cv.COLOR_HSV2BGR)
+            if not (kwargs.get('return_back') or return_back):
+                new_image = new_image / 255.
+        else:
+            x = rgb_to_hsv(img / 255.)
+            x[..., 0] += hue
+            x[..., 0][x[..., 0] > 1] -= 1
+            x[..., 0][x[..., 0] < 0] += 1
+            x[..., 1] *= sat
+            x[..., 2] *= val
+            x[x > 1] = 1
+            x[x < 0] = 0
+            new_image = hsv_to_rgb(x)
+            if kwargs.get('return_back') or return_back:
+                new_image *= 255
+                new_image = np.asarray(new_image, np.uint8)
         if not len(boxes):
             boxes = []
         return new_image, boxes
@@ -693,59 +876,145 @@ class Augment:
         :param kwargs:
         :return:
         """
+        rng = kwargs.get('rng')
         new_h, new_w = new_shape
-        bg_img = np.zeros(shape=(*new_shape, 3))
-        x0_ratio, y0_ratio = Augment.set_random(70, 30) / 100.0, Augment.set_random(70, 30) / 100.0
+        bg_img = np.empty(shape=(new_h, new_w, 3), dtype=np.uint8)
+        x0_ratio, y0_ratio = Augment.set_random(70, 30, rng=rng) / 100.0, Augment.set_random(70, 30, rng=rng) / 100.0
         x0, y0 = int(round(new_w * x0_ratio)), int(round(new_h * y0_ratio))
-        pic1_w, pic1_h = x0, y0
-        pic2_w, pic2_h = new_w - x0, y0
-        pic3_w, pic3_h = x0, new_h - y0
-        pic4_w, pic4_h = new_w - x0, new_h - y0
-        shapes = [(pic1_h, pic1_w), (pic2_h, pic2_w), (pic3_h, pic3_w), (pic4_h, pic4_w)]
+        # (x, y, w, h) of the 4 quadrants
+        quadrants = [(0, 0, x0, y0), (x0, 0, new_w - x0, y0), (0, y0, x0, new_h - y0), (x0, y0, new_w - x0, new_h - y0)]
 
         img_info_list = kwargs.get('img_info_list') or img_info_list
         if img_info_list:
-            imgs, boxes = Augment.load_file_from_list(img_info_list, 4)
+            imgs, boxes = Augment.load_file_from_list(img_info_list, 4, rng=rng)
         elif imgs_path:
-            imgs = [cv.imread(img_path) for img_path in imgs_path]
-        elif imgs:
+            imgs = [image_cache.read(img_path) for img_path in imgs_path]
+        elif imgs is not None and len(imgs):
+            # decoded (maybe cached, read-only) images are only read, never copied
             if len(imgs) == 1:
-                imgs = [copy.deepcopy(imgs[0]) for i in range(4)]
+                imgs = [imgs[0]] * 4
+                boxes = [boxes[0]] * 4
         else:
             assert 1 == 2, 'lack of some params for function, check it again!'
 
-        new_boxes = []
-
-        for i in range(len(imgs)):
-            img = imgs[i]
-            box = boxes[i]
-            shape = shapes[i]
-
-            box[:, 0] = box[:, 0] * shape[1] / img.shape[1]
-            box[:, 2] = box[:, 2] * shape[1] / img.shape[1]
-            box[:, 1] = box[:, 1] * shape[0] / img.shape[0]
-            box[:, 3] = box[:, 3] * shape[0] / img.shape[0]
-
-            img = cv.resize(img, shape[::-1], interpolation=cv.INTER_CUBIC)
-
-            img, box = Augment.flip(img, box, flip_code=Augment.set_random(2) - 1)
+        box_list = []
+        for img, box, (x, y, w, h) in zip(imgs, boxes, quadrants):
+            # resize straight into the quadrant of the background, then flip it in place
+            dst = bg_img[y: y + h, x: x + w]
+            cv.resize(img, (w, h), dst=dst, interpolation=cv.INTER_CUBIC)
+            flip_code = Augment.set_random(2, rng=rng) - 1
+            cv.flip(dst, flip_code, dst=dst)
+
+            box = np.array(box, dtype=int).reshape(-1, 5)
+            box[:, [0, 2]] = box[:, [0, 2]] * w / img.shape[1]
+            box[:, [1, 3]] = box[:, [1, 3]] * h / img.shape[0]
+            box = Augment.correct_boxes(h, w, box, aug_type='flip', flip_code=flip_code)
+            box_list.append(box + [x, y, x, y, 0])
+        new_boxes = np.vstack(box_list)
+        return bg_img, new_boxes
+
+
+class BatchAugment:
+    """
+    flip, colors and normalization of a whole batch at once, run after samples are stacked.
+
+    every sample still gets its own random params, but the work is done by a handful of numpy calls over
+    (N, H, W, 3) instead of python calls per op per sample. colors are one 3x3 matrix per sample
+    (hue rotation in YIQ space, saturation and value scaling, and the 1/255 normalization), applied with a
+    single batched matmul, so it is a linear approximation of Augment.colors.
+
+    example:
+            batch_augment = BatchAugment()
+            augment = Augment(img_path=..., boxes=..., policy=batch_augment.sample_policy, normalize=False)
+            ...
+            image_data, box_data = batch_augment(image_data, box_data, rng)
+    """
+    batch_ops = ('flip', 'colors')
+
+    # RGB -> YIQ
+    yiq = np.array([[0.299, 0.587, 0.114],
+                    [0.596, -0.274, -0.322],
+                    [0.211, -0.523, 0.312]])
+
+    def __init__(self, policy: dict = None, normalize: bool = True):
+        """
+        :param policy:      same as Augment, default is config.augment_policy.
+                            flip and colors run here, the rest stays in sample_policy for Augment
+        :param normalize:   True returns float32 images in [0, 1], False returns uint8 images
+        """
+        self.normalize = normalize
+        policy = policy or config.augment_policy
+        self.flip_policy = policy.get('flip', {'p': 0.})
+        self.colors_policy = policy.get('colors', {'p': 0.})
+        self.sample_policy = {op: params for op, params in policy.items() if op not in self.batch_ops}
 
-            if i == 0:
-                bg_img[:y0, :x0, :] = img
-            elif i == 1:
-                bg_img[:y0, x0:, :] = img
-                box[:, 0] += x0
-                box[:, 2] += x0
-            elif i == 2:
-                bg_img[y0:, :x0, :] = img
-                box[:, 1] += y0
-                box[:, 3] += y0
-            else:
-                bg_img[y0:, x0:, :] = img
-                box[:, 0] += x0
-                box[:, 1] += y0
-                box[:, 2] += x0
-                box[:, 3] += y0
-            new_boxes.append(box)
-        new_boxes = np.vstack(new_boxes)
-        return np.asarray(bg_img, dtype=np.uint8), new_boxes
+    def flip(self, images: np.ndarray, boxes: np.ndarray, rng=None):
+        """
+        :param images:      (N, H, W, 3)
+        :param boxes:       (N, max_boxes, 5), padded with zeros
+        :param rng:
+        :return:            flipped in place
+        """
+        rng = rng or np.random
+        n, h, w = images.shape[:3]
+        flip_codes = np.asarray(self.flip_policy.get('flip_codes', (-1, 0, 1)))
+        do_flip = rng.rand(n) < self.flip_policy.get('p', 1.)
+        flip_code = flip_codes[rng.randint(0, len(flip_codes), n)]
+        flip_x = do_flip & (flip_code != 0)
+        flip_y = do_flip & (flip_code != 1)
+        if flip_x.any():
+            images[flip_x] = images[flip_x, :, ::-1]
+        if flip_y.any():
+            images[flip_y] = images[flip_y, ::-1]
+
+        # padded boxes stay zeros
+        valid = boxes[..., 2] > boxes[..., 0]
+        mask_x = valid & flip_x[:, None]
+        mask_y = valid & flip_y[:, None]
+        boxes[..., [0, 2]] = np.where(mask_x[..., None], w - boxes[..., [2, 0]], boxes[..., [0, 2]])
+        boxes[..., [1, 3]] = np.where(mask_y[..., None], h - boxes[..., [3, 1]], boxes[..., [1, 3]])
+        return images, boxes
+
+    def color_matrices(self, n: int, rng=None):
+        """
+        :return:        (n, 3, 3) matrices for BGR pixels, the 1/255 normalization is included if self.normalize
+        """
+        rng = rng or np.random
+        hue = self.colors_policy.get('hue', config.hue)
+        sat = self.colors_policy.get('sat', config.sat)
+        val = self.colors_policy.get('val', config.val)
+        do_colors = rng.rand(n) < self.colors_policy.get('p', 1.)
+
+        # same distributions as Augment.colors
+        angle = rng.uniform(-hue, hue, n) * 2 * np.pi
+        sat = rng.uniform(1, sat, n) ** np.where(rng.rand(n) < .5, 1, -1)
+        val = rng.uniform(1, val, n) ** np.where(rng.rand(n) < .5, 1, -1)
+        angle, sat, val = np.where(do_colors, angle, 0), np.where(do_colors, sat, 1), np.where(do_colors, val, 1)
+
+        cos, sin = np.cos(angle) * sat, np.sin(angle) * sat
+        # hue rotation and saturation scaling of the IQ plane
+        iq = np.zeros((n, 3, 3))
+        iq[:, 0, 0] = 1
+        iq[:, 1, 1], iq[:, 1, 2] = cos, -sin
+        iq[:, 2, 1], iq[:, 2, 2] = sin, cos
+        matrices = np.linalg.inv(self.yiq) @ iq @ self.yiq * val[:, None, None]
+        # RGB -> BGR
+        matrices = matrices[:, ::-1, ::-1]
+        return matrices / 255. if self.normalize else matrices
+
+    def __call__(self, images: np.ndarray, boxes: np.ndarray, rng=None):
+        """
+        :param images:      (N, H, W, 3) raw pixels in [0, 255], BGR
+        :param boxes:       (N, max_boxes, 5)
+        :param rng:
+        :return:            float32 images in [0, 1] (uint8 if not self.normalize), boxes
+        """
+        images, boxes = self.flip(images, boxes, rng)
+        n = len(images)
+        matrices = self.color_matrices(n, rng).astype(np.float32)
+        x = images.reshape(n, -1, 3).astype(np.float32)
+        x = np.matmul(x, matrices.transpose(0, 2, 1), out=x)
+        if self.normalize:
+            return np.clip(x, 0, 1, out=x).reshape(images.shape), boxes
+        x = np.clip(np.round(x, out=x), 0, 255, out=x)
+        return x.astype(np.uint8).reshape(images.shape), boxes
@@ -15,59 +15,152 @@ this is the entrance for training
 import loss
 import config
 import models
+import tensorflow as tf
 from tensorflow import keras
-from generator import data_generator
+from generator import data_generator, parallel_data_generator, tf_data_generator
+from tools.utils_data import ShardReader
 
 
 class_mapping = dict(enumerate(config.classes_names))
 class_mapping = {class_mapping[key]: key for key in class_mapping}
 
 
-model_yolo = models.YOLO(pre_train=None)()
+model_yolo = models.YOLO(pre_train=None, uint8_input=config.uint8_input, precision=config.precision)()
 
-f = open(config.label_path)
-label_lines = f.readlines()
+assert not (config.multi_scale_shapes and config.loader == 'tf_data'), 'tf_data loader has no multi-scale training'
+if config.shard_path:
+    assert config.loader != 'tf_data', 'tf_data loader reads config.label_path, unset config.shard_path'
+    label_lines = ShardReader(config.shard_path)
+else:
+    f = open(config.label_path)
+    label_lines = f.readlines()
 
 train_lines = label_lines[:-int(len(label_lines) * config.validation_split)]
 valid_lines = label_lines[-int(len(label_lines) * config.validation_split):]
 
 h, w = config.image_input_shape
-y_true = [keras.layers.Input(shape=(h // config.scale_size[l], w // config.scale_size[l], config.num_anchors, config.num_classes + 5)) for l
-          in range(3)]
-
-model_loss = keras.layers.Lambda(function=loss.yolo4_loss, output_shape=(1,), name='yolo_loss')([*model_yolo.output, *y_true])
+if config.encode_in_graph:
+    # padded boxes, encoded into y_true inside the loss
+    y_true = [keras.layers.Input(shape=(config.max_boxes, 5))]
+elif config.multi_scale_shapes:
+    # grid sizes change with the input shape of every batch
+    y_true = [keras.layers.Input(shape=(None, None, config.num_anchors, config.num_classes + 5)) for l in range(3)]
+else:
+    y_true = [keras.layers.Input(shape=(h // config.scale_size[l], w // config.scale_size[l], config.num_anchors, config.num_classes + 5)) for l
+              in range(3)]
+
+model_loss = keras.layers.Lambda(function=loss.yolo4_box_loss if config.encode_in_graph else loss.yolo4_loss,
+                                 output_shape=(1,), name='yolo_loss')([*model_yolo.output, *y_true])
 
 tensorboard = keras.callbacks.TensorBoard()
-checkpoint = keras.callbacks.ModelCheckpoint(filepath='model_train/ep{epoch:03d}-loss{loss:.3f}-valloss{val_loss:.3f}.h5',
+checkpoint = keras.callbacks.ModelCheckpoint(filepath='model_train/ep{epoch:03d}-loss{loss:.3f}-valloss{val_loss:.3f}.weights.h5',
                                              monitor='val_loss',
                                              save_weights_only=True,
-                                             save_best_only=True,
-                                             period=1)
+                                             save_best_only=True)
 reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=10, verbose=1)
 early_stopping = keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=0, patience=20, verbose=1)
 
 model = keras.models.Model([model_yolo.input, *y_true], model_loss)
-model.compile(optimizer=keras.optimizers.Adam(1e-4), loss={'yolo_loss': lambda y_true, y_pred: y_pred})
-
-
-g_train = data_generator(label_lines=train_lines,
-                         batch_size=config.batch_size,
-                         input_shape=config.image_input_shape,
-                         anchors=config.anchors,
-                         num_classes=config.num_classes)
+optimizer = keras.optimizers.Adam(1e-4)
+if config.precision == 'mixed_float16':
+    optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+model.compile(optimizer=optimizer, loss={'yolo_loss': lambda y_true, y_pred: y_pred})
+
+
+if config.loader == 'parallel':
+    g_train = parallel_data_generator(label_lines=train_lines,
+                                      batch_size=config.batch_size,
+                                      input_shape=config.image_input_shape,
+                                      anchors=config.anchors,
+                                      num_classes=config.num_classes,
+                                      workers=config.workers,
+                                      prefetch=config.prefetch,
+                                      seed=config.seed,
+                                      batch_augment=config.batch_augment,
+                                      uint8_input=config.uint8_input,
+                                      encode=not config.encode_in_graph,
+                                      max_boxes=config.max_boxes,
+                                      input_shapes=config.multi_scale_shapes,
+                                      scale_interval=config.multi_scale_interval)
+
+    g_valid = parallel_data_generator(label_lines=valid_lines,
+                                      batch_size=config.batch_size,
+                                      input_shape=config.image_input_shape,
+                                      anchors=config.anchors,
+                                      num_classes=config.num_classes,
+                                      workers=config.workers,
+                                      prefetch=config.prefetch,
+                                      seed=config.seed,
+                                      batch_augment=config.batch_augment,
+                                      uint8_input=config.uint8_input,
+                                      encode=not config.encode_in_graph,
+                                      max_boxes=config.max_boxes)
+elif config.loader == 'tf_data':
+    g_train = tf_data_generator(label_lines=train_lines,
+                                batch_size=config.batch_size,
+                                input_shape=config.image_input_shape,
+                                anchors=config.anchors,
+                                num_classes=config.num_classes,
+                                uint8_input=config.uint8_input,
+                                encode=not config.encode_in_graph,
+                                max_boxes=config.max_boxes,
+                                seed=config.seed,
+                                batch_augment=config.batch_augment)
+
+    g_valid = tf_data_generator(label_lines=valid_lines,
+                                batch_size=config.batch_size,
+                                input_shape=config.image_input_shape,
+                                anchors=config.anchors,
+                                num_classes=config.num_classes,
+                                uint8_input=config.uint8_input,
+                                encode=not config.encode_in_graph,
+                                max_boxes=config.max_boxes,
+                                seed=config.seed,
+                                batch_augment=config.batch_augment)
+else:
+    g_train = data_generator(label_lines=train_lines,
+                             batch_size=config.batch_size,
+                             input_shape=config.image_input_shape,
+                             anchors=config.anchors,
+                             num_classes=config.num_classes,
+                             seed=config.seed,
+                             batch_augment=config.batch_augment,
+                             uint8_input=config.uint8_input,
+                             encode=not config.encode_in_graph,
+                             max_boxes=config.max_boxes,
+                             input_shapes=config.multi_scale_shapes,
+                             scale_interval=config.multi_scale_interval)
+
+    g_valid = data_generator(label_lines=valid_lines,
+                             batch_size=config.batch_size,
+                             input_shape=config.image_input_shape,
+                             anchors=config.anchors,
+                             num_classes=config.num_classes,
+                             seed=config.seed,
+                             batch_augment=config.batch_augment,
+                             uint8_input=config.uint8_input,
+                             encode=not config.encode_in_graph,
+                             max_boxes=config.max_boxes)
+if config.multi_scale_shapes:
+    # keras fixes the shapes of a python generator from its first batches, tf.data with None height and width
+    # lets the input shape change per batch
+    image_spec = tf.TensorSpec((None, None, None, 3), 'uint8' if config.uint8_input else 'float32')
+    if config.encode_in_graph:
+        target_specs = (tf.TensorSpec((None, config.max_boxes, 5), 'float32'),)
+    else:
+        target_specs = tuple(tf.TensorSpec((None, None, None, config.num_anchors, config.num_classes + 5), 'float32')
+                             for l in range(3))
+    g_train = tf.data.Dataset.from_generator(lambda g=g_train: g,
+                                             output_signature=((image_spec, *target_specs),
+                                                               tf.TensorSpec((None,), 'float64')))
 
-g_valid = data_generator(label_lines=valid_lines,
-                         batch_size=config.batch_size,
-                         input_shape=config.image_input_shape,
-                         anchors=config.anchors,
-                         num_classes=config.num_classes)
 print('fire!')
 model.fit(g_train,
           validation_data=g_valid,
           steps_per_epoch=len(label_lines) // config.batch_size,
-          validation_steps=int(len(label_lines) * config.validation_split * 0.2),
+          validation_steps=max(int(len(label_lines) * config.validation_split * 0.2), 1),
           epochs=config.epochs,
           callbacks=[tensorboard, checkpoint, reduce_lr]
           )
 
-model_yolo.save_weights('model_train/model_train_final.weights')
+model_yolo.save_weights('model_train/model_train_final.weights.h5')
@@ -0,0 +1,216 @@
+"""
+custom training loop, another entrance for training besides train.py.
+
+the forward pass and the loss run in one tf.function, optionally compiled by XLA (jit_compile),
+gradients of `subdivisions` batches are accumulated before every update, the same as batch/subdivisions
+in model_data/train_net.cfg, and the throughput of every step is reported
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+import config
+import loss
+import models
+from generator import data_generator, parallel_data_generator, tf_data_generator
+from tools.utils_data import ShardReader
+
+
+class Trainer:
+    """
+    example, batch=64 subdivisions=16 of darknet:
+        trainer = Trainer(models.YOLO(pre_train=None)(), keras.optimizers.Adam(1e-4), subdivisions=16)
+        trainer.fit(data_generator(train_lines, batch_size=4, ...), steps_per_epoch=100, epochs=10)
+    """
+
+    def __init__(self,
+                 model,
+                 optimizer,
+                 loss_function=loss.yolo4_loss,
+                 subdivisions: int = 1,
+                 jit_compile: bool = False):
+        """
+
+        :param model:               models.YOLO()()
+        :param optimizer:           keras optimizer, wrap it with keras.mixed_precision.LossScaleOptimizer for mixed_float16
+        :param loss_function:       loss.yolo4_loss for dense y_true, loss.yolo4_box_loss for padded boxes
+        :param subdivisions:        count of batches whose gradients are accumulated before every update,
+                                    one update sees batch_size * subdivisions images
+        :param jit_compile:         compile forward pass and loss with XLA. compiling the full 608x608 model
+                                    takes tens of minutes on CPU, and every new input shape (multi-scale training)
+                                    is compiled again on its first step, so it pays off only on long fixed-shape runs
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_function = loss_function
+        self.subdivisions = subdivisions
+        self.optimizer.build(model.trainable_variables)
+        # 梯度累加器, 每次更新后清零
+        self.gradients = [tf.Variable(tf.zeros_like(variable), trainable=False) for variable in
+                          model.trainable_variables]
+        self._accumulate = tf.function(self.accumulate, jit_compile=jit_compile)
+        self._evaluate = tf.function(self.evaluate, jit_compile=jit_compile)
+        self._apply = tf.function(self.apply)
+
+    def compute_loss(self, images, targets, training):
+        outputs = self.model(images, training=training)
+        loss_value = tf.reduce_mean(self.loss_function([*outputs, *targets]))
+        # l2 of conv kernels, the same as keras fit adds
+        if self.model.losses:
+            loss_value += tf.add_n(self.model.losses)
+        return loss_value
+
+    def accumulate(self, images, targets):
+        """
+        forward and backward of one batch, its gradients are added into the accumulators
+        """
+        with tf.GradientTape() as tape:
+            loss_value = self.compute_loss(images, targets, training=True)
+            # LossScaleOptimizer放大loss, apply时再缩回; 其余optimizer原样返回
+            scaled_loss = self.optimizer.scale_loss(loss_value)
+        gradients = tape.gradient(scaled_loss, self.model.trainable_variables)
+        for accumulator, gradient in zip(self.gradients, gradients):
+            accumulator.assign_add(gradient / self.subdivisions)
+        return loss_value
+
+    def evaluate(self, images, targets):
+        return self.compute_loss(images, targets, training=False)
+
+    def apply(self):
+        """
+        update with the mean gradients of the accumulated batches, then reset the accumulators
+        """
+        self.optimizer.apply_gradients(zip([accumulator.read_value() for accumulator in self.gradients],
+                                           self.model.trainable_variables))
+        for accumulator in self.gradients:
+            accumulator.assign(tf.zeros_like(accumulator))
+
+    def train_step(self, batches):
+        """
+
+        :param batches:     iterator of generator outputs, `subdivisions` batches are taken from it
+        :return:            mean loss, count of images, seconds spent waiting for batches
+        """
+        losses = []
+        num_images = 0
+        data_time = 0.
+        for _ in range(self.subdivisions):
+            start = time.perf_counter()
+            inputs, _ = next(batches)
+            data_time += time.perf_counter() - start
+            losses.append(self._accumulate(inputs[0], list(inputs[1:])))
+            num_images += len(inputs[0])
+        self._apply()
+        return float(np.mean([loss_value.numpy() for loss_value in losses])), num_images, data_time
+
+    def fit(self,
+            g_train,
+            steps_per_epoch: int,
+            epochs: int,
+            g_valid=None,
+            validation_steps: int = 0,
+            log_interval: int = 10,
+            checkpoint_path: str = 'model_train/ep{epoch:03d}-loss{loss:.3f}-valloss{val_loss:.3f}.weights.h5'):
+        """
+
+        :param g_train:             generator or tf.data.Dataset from generator.py
+        :param steps_per_epoch:     count of updates in every epoch
+        :param epochs:
+        :param g_valid:             same as g_train, None to skip validation
+        :param validation_steps:    count of validation batches in every epoch
+        :param log_interval:        print every log_interval updates
+        :param checkpoint_path:     weights are saved here whenever val_loss (loss without g_valid) improves
+        :return:                    history, list of {'loss', 'val_loss', 'images_per_second'} of every epoch
+        """
+        train_batches = iter(g_train)
+        valid_batches = iter(g_valid) if g_valid is not None else None
+        history = []
+        best_loss = np.inf
+        for epoch in range(1, epochs + 1):
+            losses = []
+            epoch_images = 0
+            epoch_time = 0.
+            for step in range(1, steps_per_epoch + 1):
+                start = time.perf_counter()
+                loss_value, num_images, data_time = self.train_step(train_batches)
+                cost = time.perf_counter() - start
+                losses.append(loss_value)
+                # 第一步包含tf.function追踪(和XLA编译)时间, 不计入吞吐
+                if step > 1:
+                    epoch_images += num_images
+                    epoch_time += cost
+                if step % log_interval == 0 or step == steps_per_epoch:
+                    print('epoch {} step {}/{} - loss: {:.4f} - {:.3f}s/step (data {:.3f}s) - {:.1f} images/s'.format(
+                        epoch, step, steps_per_epoch, np.mean(losses), cost, data_time, num_images / cost))
+
+            logs = {'loss': float(np.mean(losses)),
+                    'images_per_second': epoch_images / epoch_time if epoch_time else 0.}
+            if valid_batches is not None and validation_steps:
+                val_losses = []
+                for _ in range(validation_steps):
+                    inputs, _ = next(valid_batches)
+                    val_losses.append(self._evaluate(inputs[0], list(inputs[1:])).numpy())
+                logs['val_loss'] = float(np.mean(val_losses))
+            else:
+                logs['val_loss'] = logs['loss']
+            history.append(logs)
+            print('epoch {} - loss: {:.4f} - val_loss: {:.4f} - {:.1f} images/s'.format(
+                epoch, logs['loss'], logs['val_loss'], logs['images_per_second']))
+
+            if checkpoint_path and logs['val_loss'] < best_loss:
+                best_loss = logs['val_loss']
+                self.model.save_weights(checkpoint_path.format(epoch=epoch, **logs))
+        return history
+
+
+def get_generator(label_lines, training=True):
+    """
+    the generator selected by config.loader, with the same settings as train.py
+    """
+    kwargs = dict(label_lines=label_lines,
+                  batch_size=config.batch_size,
+                  input_shape=config.image_input_shape,
+                  anchors=config.anchors,
+                  num_classes=config.num_classes,
+                  uint8_input=config.uint8_input,
+                  encode=not config.encode_in_graph,
+                  max_boxes=config.max_boxes)
+    kwargs.update(seed=config.seed, batch_augment=config.batch_augment)
+    if config.loader == 'tf_data':
+        return tf_data_generator(**kwargs)
+    if training:
+        kwargs.update(input_shapes=config.multi_scale_shapes, scale_interval=config.multi_scale_interval)
+    if config.loader == 'parallel':
+        return parallel_data_generator(workers=config.workers, prefetch=config.prefetch, **kwargs)
+    return data_generator(**kwargs)
+
+
+if __name__ == '__main__':
+    assert not (config.multi_scale_shapes and config.loader == 'tf_data'), 'tf_data loader has no multi-scale training'
+    if config.shard_path:
+        assert config.loader != 'tf_data', 'tf_data loader reads config.label_path, unset config.shard_path'
+        label_lines = ShardReader(config.shard_path)
+    else:
+        f = open(config.label_path)
+        label_lines = f.readlines()
+
+    train_lines = label_lines[:-int(len(label_lines) * config.validation_split)]
+    valid_lines = label_lines[-int(len(label_lines) * config.validation_split):]
+
+    optimizer = keras.optimizers.Adam(1e-4)
+    if config.precision == 'mixed_float16':
+        optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+    trainer = Trainer(models.YOLO(pre_train=None, uint8_input=config.uint8_input, precision=config.precision)(),
+                      optimizer,
+                      loss_function=loss.yolo4_box_loss if config.encode_in_graph else loss.yolo4_loss,
+                      subdivisions=config.subdivisions,
+                      jit_compile=config.jit_compile)
+    print('fire!')
+    trainer.fit(get_generator(train_lines),
+                steps_per_epoch=len(train_lines) // (config.batch_size * config.subdivisions),
+                epochs=config.epochs,
+                g_valid=get_generator(valid_lines, training=False),
+                validation_steps=max(len(valid_lines) // config.batch_size, 1))
+
+    trainer.model.save_weights('model_train/model_train_final.weights.h5')